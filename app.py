@@ -1,19 +1,20 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, g
-import sqlite3, os, re
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, g, has_app_context, Response
+import sqlite3, os, re, queue, uuid
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
 from flask import send_from_directory
-import csv, math
+import csv, math, zlib
 import json
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
-from collections import defaultdict
-import random
+from collections import defaultdict, OrderedDict
 import time
 import threading
 import numpy as np
+import scipy.sparse as sp
 from datetime import datetime, timedelta
+from statistics import NormalDist
 
 '''
 「WAL 解決的是讀寫並行問題，
@@ -84,13 +85,8 @@ def _db_path():
     return os.path.join(os.path.dirname(__file__), "app.db")
 
 def _accounts_password_col():
-    """偵測 accounts 表要存哪個欄位：password_hash 或 password。"""
-    try:
-        con = sqlite3.connect(_db_path())
-        cur = con.execute("PRAGMA table_info(accounts)")
-        cols = {row[1] for row in cur.fetchall()}
-    finally:
-        con.close()
+    """偵測 accounts 表要存哪個欄位：password_hash 或 password（讀 ensure_schema() 快取的欄位配置）。"""
+    cols = SCHEMA_COLUMNS.get("accounts", set())
     if "password_hash" in cols:
         return "password_hash"
     elif "password" in cols:
@@ -99,65 +95,6 @@ def _accounts_password_col():
         # 沒有密碼欄位就拋錯，避免悶錯
         raise RuntimeError("accounts 表缺少 password 或 password_hash 欄位")
     
-def ensure_user_prefs_table():
-    con = sqlite3.connect(_db_path())
-    try:
-        # 只保證表存在；不動你既有欄位（user_id, category, weight）
-        con.execute("""
-            CREATE TABLE IF NOT EXISTS user_preferences (
-                user_id   INTEGER NOT NULL REFERENCES accounts(id),
-                category  TEXT    NOT NULL,
-                weight    REAL    NOT NULL DEFAULT 1.0,
-                PRIMARY KEY(user_id, category)         -- 複合主鍵，供 ON CONFLICT 使用
-            );
-        """)
-        con.commit()
-    finally:
-        con.close()
-
-#通知系統(低庫存or收藏商品特價)
-# --- front_remaining_final integration: notifications schema helper (additive) ---
-def __ensure_notifications_schema():
-    import sqlite3, os
-    db_path = os.path.join(os.path.dirname(__file__), "app.db")
-    con = sqlite3.connect(db_path)
-    try:
-        cur = con.cursor()
-        # 先確保有最小結構（舊表也能套用；已存在不會覆蓋）
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS notifications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL DEFAULT 0,
-                message TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        con.commit()
-
-        # 讀現有欄位
-        cur.execute("PRAGMA table_info(notifications)")
-        have = {row[1] for row in cur.fetchall()}
-
-        # 需要補的欄位
-        adds = []
-        if "product_id"   not in have: adds.append(("product_id",   "INTEGER"))
-        if "product_name" not in have: adds.append(("product_name", "TEXT"))
-        if "address"      not in have: adds.append(("address",      "TEXT"))
-        if "latitude"     not in have: adds.append(("latitude",     "REAL"))
-        if "longitude"    not in have: adds.append(("longitude",    "REAL"))
-
-        # 逐一 ALTER TABLE 補欄位（存在就跳過）
-        for col, typ in adds:
-            try:
-                cur.execute(f"ALTER TABLE notifications ADD COLUMN {col} {typ}")
-            except Exception:
-                pass
-
-        con.commit()
-    finally:
-        try: con.close()
-        except: pass
-
 def user_has_prefs(user_id: int | None) -> bool:
     if not user_id:
         return False
@@ -171,7 +108,6 @@ def user_has_prefs(user_id: int | None) -> bool:
 # --- 儲存/更新使用者偏好 ---
 def save_user_prefs(user_id: int, categories: list[str]):
     """把這次勾選的品類存進去：沒勾到的刪除、勾到的逐筆 UPSERT。"""
-    ensure_user_prefs_table()
     cats = [str(x) for x in categories]
 
     con = sqlite3.connect(_db_path())
@@ -200,20 +136,42 @@ def save_user_prefs(user_id: int, categories: list[str]):
         con.commit()
     finally:
         con.close()
+    invalidate_results(user_id)
         
-def ensure_schema():
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    # stores.brand
-    cur.execute("PRAGMA table_info(stores)"); cols=[r[1] for r in cur.fetchall()]
-    if "brand" not in cols:
-        try: cur.execute("ALTER TABLE stores ADD COLUMN brand TEXT")
-        except: pass
-    # products.category
-    cur.execute("PRAGMA table_info(products)"); pcols=[r[1] for r in cur.fetchall()]
-    if "category" not in pcols:
-        try: cur.execute("ALTER TABLE products ADD COLUMN category TEXT")
-        except: pass
+#資料庫版本遷移（Schema Migration）
+# 所有欄位/資料表的補建都集中成有編號的步驟，啟動時只執行 schema_version 還沒記錄的步驟，
+# 並把解析好的欄位配置快取在 SCHEMA_COLUMNS；熱路徑不再需要 PRAGMA table_info。
+# 新增結構變更時請在 MIGRATIONS 最後面加一個新版本，不要修改已發佈的步驟。
+SCHEMA_COLUMNS = {}   # table -> set(欄位名稱)，由 ensure_schema() 填入
+
+def _table_columns(cur, table):
+    return {r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()}
+
+def _add_column(cur, table, col, typ):
+    """欄位不存在才 ALTER TABLE（舊資料庫可能已經手動補過）。"""
+    if col not in _table_columns(cur, table):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {col} {typ}")
+
+def _m001_base_columns(cur):
+    _add_column(cur, "stores", "brand", "TEXT")
+    _add_column(cur, "products", "category", "TEXT")
+    _add_column(cur, "accounts", "avatar_url", "TEXT")
+
+def _m002_notifications(cur):
+    # 先確保有最小結構（舊表也能套用；已存在不會覆蓋）
+    cur.execute("""CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL DEFAULT 0,
+        message TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""")
+    _add_column(cur, "notifications", "product_id",   "INTEGER")
+    _add_column(cur, "notifications", "product_name", "TEXT")
+    _add_column(cur, "notifications", "address",      "TEXT")
+    _add_column(cur, "notifications", "latitude",     "REAL")
+    _add_column(cur, "notifications", "longitude",    "REAL")
+
+def _m003_prefs_reviews_ads(cur):
     # preferences
     cur.execute("""CREATE TABLE IF NOT EXISTS user_preferences(
         user_id INTEGER NOT NULL,
@@ -240,15 +198,446 @@ def ensure_schema():
         link_url TEXT,
         is_active INTEGER NOT NULL DEFAULT 1
     )""")
-    con.commit(); con.close()
 
-def haversine(lat1, lon1, lat2, lon2):
+def _m004_store_rtree(cur):
+    # 門市座標 R*Tree 索引（距離查詢先用外接矩形縮小範圍）
+    cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS store_rtree USING rtree(
+        id, min_lat, max_lat, min_lng, max_lng
+    )""")
+    cur.execute("DELETE FROM store_rtree WHERE id NOT IN (SELECT id FROM stores)")
+    cur.execute("""INSERT INTO store_rtree (id, min_lat, max_lat, min_lng, max_lng)
+        SELECT id, latitude, latitude, longitude, longitude FROM stores
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+          AND id NOT IN (SELECT id FROM store_rtree)""")
+    # 以 trigger 同步 stores 的新增/修改/刪除（匯入腳本直接寫 DB 也能跟上）
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS stores_rtree_ai AFTER INSERT ON stores
+        WHEN NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL
+        BEGIN
+            INSERT OR REPLACE INTO store_rtree (id, min_lat, max_lat, min_lng, max_lng)
+            VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+        END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS stores_rtree_au AFTER UPDATE OF latitude, longitude ON stores
+        BEGIN
+            DELETE FROM store_rtree WHERE id = OLD.id;
+            INSERT INTO store_rtree (id, min_lat, max_lat, min_lng, max_lng)
+            SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+            WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+        END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS stores_rtree_ad AFTER DELETE ON stores
+        BEGIN
+            DELETE FROM store_rtree WHERE id = OLD.id;
+        END""")
+
+def _m005_store_stock_summary(cur):
+    # 門市庫存彙總（由 update_stock() 增量維護，讀取端只需主鍵查詢）
+    cur.execute("""CREATE TABLE IF NOT EXISTS store_stock_summary(
+        store_id  INTEGER PRIMARY KEY REFERENCES stores(id) ON DELETE CASCADE,
+        total_qty INTEGER NOT NULL DEFAULT 0
+    )""")
+
+def _m006_product_rating_stats(cur):
+    # 商品評分彙總（新增評價時一起更新，列表查詢不必再跑 AVG/COUNT 子查詢）
+    cur.execute("""CREATE TABLE IF NOT EXISTS product_rating_stats(
+        product_id   INTEGER PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+        rating_sum   INTEGER NOT NULL DEFAULT 0,
+        rating_count INTEGER NOT NULL DEFAULT 0,
+        avg_rating   REAL
+    )""")
+
+def _m008_demand_model(cur):
+    # 每次 tick 的庫存變化紀錄（一個 tick 一列，deltas 為 {"product_id": 變化量} JSON）
+    cur.execute("""CREATE TABLE IF NOT EXISTS stock_deltas(
+        id        INTEGER PRIMARY KEY AUTOINCREMENT,
+        tick_at   TEXT NOT NULL,
+        restocked INTEGER NOT NULL DEFAULT 0,
+        deltas    TEXT NOT NULL
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stock_deltas_tick ON stock_deltas(tick_at)")
+    # 每個商品 × 每小時的需求量串流統計（Welford：筆數、平均、離均差平方和）
+    cur.execute("""CREATE TABLE IF NOT EXISTS demand_stats(
+        product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+        hour       INTEGER NOT NULL,
+        n          INTEGER NOT NULL,
+        mean       REAL NOT NULL,
+        m2         REAL NOT NULL,
+        PRIMARY KEY (product_id, hour)
+    ) WITHOUT ROWID""")
+
+def _m009_stock_history(cur):
+    # 庫存歷史：每商品每小時一列，qty 為壓縮後的 60 個分鐘值，另存該小時的彙總（分鐘資料過期後只留彙總）
+    cur.execute("""CREATE TABLE IF NOT EXISTS stock_history(
+        product_id INTEGER NOT NULL,
+        hour       INTEGER NOT NULL,   -- unix 時間 // 3600
+        qty        BLOB,
+        min_qty    INTEGER NOT NULL,
+        max_qty    INTEGER NOT NULL,
+        avg_qty    REAL NOT NULL,
+        last_qty   INTEGER NOT NULL,
+        PRIMARY KEY (product_id, hour)
+    ) WITHOUT ROWID""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS stock_history_daily(
+        product_id INTEGER NOT NULL,
+        day        TEXT NOT NULL,      -- YYYY-MM-DD（本地時間）
+        min_qty    INTEGER NOT NULL,
+        max_qty    INTEGER NOT NULL,
+        avg_qty    REAL NOT NULL,
+        last_qty   INTEGER NOT NULL,
+        PRIMARY KEY (product_id, day)
+    ) WITHOUT ROWID""")
+
+def _m010_jobs(cur):
+    # 背景工作：送出後立即回傳 job id，前端輪詢或串流狀態
+    cur.execute("""CREATE TABLE IF NOT EXISTS jobs(
+        id          TEXT PRIMARY KEY,
+        kind        TEXT NOT NULL,
+        status      TEXT NOT NULL DEFAULT 'queued',   -- queued / running / done / error
+        user_id     INTEGER,
+        created_at  TEXT NOT NULL DEFAULT (datetime('now','localtime')),
+        started_at  TEXT,
+        finished_at TEXT,
+        result      TEXT,                             -- JSON
+        error       TEXT
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created_at)")
+
+def _m011_store_grid_version(cur):
+    # 距離查詢改用記憶體格子索引，store_rtree 與它的 trigger 已無人讀取
+    for trig in ("stores_rtree_ai", "stores_rtree_au", "stores_rtree_ad"):
+        cur.execute(f"DROP TRIGGER IF EXISTS {trig}")
+    cur.execute("DROP TABLE IF EXISTS store_rtree")
+    # 改以 trigger 累加版本號：匯入腳本直接寫 stores 時，格子索引也能發現並重建
+    cur.execute("""CREATE TABLE IF NOT EXISTS store_grid_version(
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    )""")
+    cur.execute("INSERT OR IGNORE INTO store_grid_version (id, version) VALUES (1, 0)")
+    for name, event in (("stores_grid_ai", "INSERT"),
+                        ("stores_grid_au", "UPDATE OF name, address, latitude, longitude, brand"),
+                        ("stores_grid_ad", "DELETE")):
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON stores
+            BEGIN
+                UPDATE store_grid_version SET version = version + 1 WHERE id = 1;
+            END""")
+
+def _m012_drop_stock_deltas(cur):
+    # 每 tick 的變化 JSON 沒有人讀：需求統計直接由記憶體陣列更新，庫存軌跡在 stock_history
+    cur.execute("DROP TABLE IF EXISTS stock_deltas")
+
+def _m013_products_version(cur):
+    # products 的外部寫入計數：匯入、後台修改、其他 process 改到商品時 +1。
+    # update_stock() 自己的寫回在同一個 transaction 內先把 tick_writing 設 1、commit 前設回 0，
+    # 其他連線永遠看不到 1，因此只有「別人」的寫入會讓版本前進。
+    cur.execute("""CREATE TABLE IF NOT EXISTS products_version(
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL,
+        tick_writing INTEGER NOT NULL DEFAULT 0
+    )""")
+    cur.execute("INSERT OR IGNORE INTO products_version (id, version, tick_writing) VALUES (1, 0, 0)")
+    for name, event in (("products_version_ai", "INSERT"), ("products_version_au", "UPDATE"),
+                        ("products_version_ad", "DELETE")):
+        cur.execute(f"""CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON products
+            WHEN (SELECT tick_writing FROM products_version WHERE id = 1) = 0
+            BEGIN
+                UPDATE products_version SET version = version + 1 WHERE id = 1;
+            END""")
+
+# 熱門查詢用到的索引（flask indexcheck 會確認都存在、且查詢計畫真的用上）
+HOT_INDEXES = [
+    ("idx_products_store",             "products(store_id, remaining_qty)"),
+    ("idx_products_category",          "products(category)"),
+    ("idx_specials_product_store_end", "specials(product_id, store_id, end_date, discount_rate)"),
+    ("idx_favorites_user_created",     "favorites(user_id, created_at)"),
+    ("idx_favorites_product",          "favorites(product_id)"),
+    ("idx_reviews_product_created",    "product_reviews(product_id, created_at)"),
+    ("idx_notifications_user_created", "notifications(user_id, created_at)"),
+    ("idx_store_stock_total",          "store_stock_summary(total_qty)"),
+]
+
+def _m007_hot_indexes(cur):
+    for name, target in HOT_INDEXES:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+
+# (版本, 說明, 步驟)；版本號只增不改
+MIGRATIONS = [
+    (1, "stores.brand / products.category / accounts.avatar_url", _m001_base_columns),
+    (2, "notifications 表與商品/地址欄位", _m002_notifications),
+    (3, "user_preferences / product_reviews / ads", _m003_prefs_reviews_ads),
+    (4, "store_rtree 與同步 trigger", _m004_store_rtree),
+    (5, "store_stock_summary", _m005_store_stock_summary),
+    (6, "product_rating_stats", _m006_product_rating_stats),
+    (7, "熱門查詢索引", _m007_hot_indexes),
+    (8, "stock_deltas / demand_stats", _m008_demand_model),
+    (9, "stock_history / stock_history_daily", _m009_stock_history),
+    (10, "jobs", _m010_jobs),
+    (11, "移除 store_rtree，改用 store_grid_version", _m011_store_grid_version),
+    (12, "移除 stock_deltas", _m012_drop_stock_deltas),
+    (13, "products_version 與同步 trigger", _m013_products_version),
+]
+
+MIGRATION_LOCK_TIMEOUT = 60   # 秒
+
+def run_migrations(con):
+    """依序執行尚未套用的 migration，每一步各自一個 transaction；回傳本次套用的版本清單。"""
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS schema_version(
+        version    INTEGER PRIMARY KEY,
+        name       TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""")
+    current = cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    applied = []
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+        # 多個 process 同時啟動：BEGIN IMMEDIATE 先拿寫入鎖，拿到後重讀版本，別人套用過的就跳過
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            current = cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+            if version <= current:
+                cur.execute("COMMIT")
+                continue
+            step(cur)
+            cur.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        applied.append(version)
+    return applied
+
+def refresh_summary_tables(con):
+    """整表重算彙總表一次，涵蓋伺服器停機期間的外部寫入（匯入、手動修改）。"""
+    cur = con.cursor()
+    cur.execute("BEGIN")
+    cur.execute("DELETE FROM store_stock_summary")
+    cur.execute("""INSERT INTO store_stock_summary (store_id, total_qty)
+        SELECT store_id, SUM(remaining_qty) FROM products GROUP BY store_id""")
+    cur.execute("DELETE FROM product_rating_stats")
+    cur.execute("""INSERT INTO product_rating_stats (product_id, rating_sum, rating_count, avg_rating)
+        SELECT product_id, SUM(rating), COUNT(*), AVG(rating) FROM product_reviews GROUP BY product_id""")
+    cur.execute("COMMIT")
+
+#熱門查詢登記（供 flask indexcheck 以 EXPLAIN QUERY PLAN 檢查）
+HOT_QUERIES = {}   # name -> (sql, 範例參數, 允許全表掃描的資料表)
+
+def hot_query(name, sql, sample_args=(), allow_scan=()):
+    """登記一條熱門查詢並原樣回傳 SQL，讓端點直接使用同一份字串，查詢改了檢查也跟著改。"""
+    HOT_QUERIES[name] = (sql, tuple(sample_args), tuple(allow_scan))
+    return sql
+
+#背景工作佇列
+# 耗時的工作（蒙地卡羅預測、推薦系統初始化、匯入門市、AI 問答）交給執行緒池，
+# 請求執行緒只負責寫一列 jobs 並回傳 job id，之後用 /api/jobs/<id> 輪詢或 /api/jobs/<id>/stream 串流結果。
+JOB_WORKERS = 4
+JOB_RETENTION_HOURS = 24   # 完成的工作保留多久，新工作送出時順便清掉過期的
+JOB_STREAM_INTERVAL = 0.5  # 串流時檢查狀態的間隔（秒）
+JOB_HANDLERS = {}          # kind -> handler(payload) -> 可 JSON 序列化的結果
+JOB_PUBLIC_KINDS = set()   # 可由 POST /api/jobs 直接送出的種類；其餘只能由站內端點 / 程式送出
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+def job_handler(kind, public=False):
+    """登記一種背景工作；public=True 才開放給 POST /api/jobs（仍需登入）。"""
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        if public:
+            JOB_PUBLIC_KINDS.add(kind)
+        return func
+    return decorator
+
+def ensure_schema():
+    """啟動時執行一次：套用 migration、重算彙總表、快取各表欄位配置。"""
+    global SCHEMA_COLUMNS
+    # 等待其他 process 套用 migration 的時間要比一般查詢長（大表的 migration 可能跑好幾秒）
+    con = sqlite3.connect(DB_PATH, timeout=MIGRATION_LOCK_TIMEOUT)
+    con.isolation_level = None   # 自行控制 BEGIN/COMMIT，讓 DDL 也包在 transaction 裡
+    try:
+        have = {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        if not {"accounts", "stores", "products"} <= have:
+            # 全新的空資料庫：等 flask initdb 建好基本表後再套用
+            print("[WARN] 資料庫尚未初始化，請先執行 flask initdb")
+            return
+        applied = run_migrations(con)
+        if applied:
+            print(f"[INFO] 已套用 schema migration: {applied}")
+        refresh_summary_tables(con)
+        cur = con.cursor()
+        SCHEMA_COLUMNS = {
+            t: _table_columns(cur, t)
+            for t in ("accounts", "stores", "products", "notifications")
+        }
+    finally:
+        con.close()
+
+def _bbox(lat, lng, radius_km):
+    """以半徑換算經緯度外接矩形 (min_lat, max_lat, min_lng, max_lng)，保證圓內的點都在矩形內。"""
     R = 6371.0
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1))*math.cos(math.radians(lat2))*(math.sin(dlon/2)**2)
-    c = 2 * math.asin(min(1, math.sqrt(a)))
-    return R * c
+    d = radius_km / R
+    dlat = math.degrees(d)
+    min_lat, max_lat = lat - dlat, lat + dlat
+    coslat = math.cos(math.radians(lat))
+    if d >= math.pi / 2 or min_lat <= -90 or max_lat >= 90 or math.sin(d) >= coslat:
+        # 半徑超過四分之一圓周或圓跨過極點：asin 公式不成立，經度不設限
+        return max(min_lat, -90.0), min(max_lat, 90.0), -180.0, 180.0
+    dlng = math.degrees(math.asin(math.sin(d) / coslat))
+    return min_lat, max_lat, lng - dlng, lng + dlng
+
+
+def bad_geo_args(lat, lng, radius):
+    """經緯度 / 半徑不是有限數字（或半徑為負）時回傳 400 回應，否則 None。"""
+    if any(v is not None and not math.isfinite(v) for v in (lat, lng, radius)) \
+            or (radius is not None and radius < 0):
+        return jsonify({"ok": False, "error": "invalid_location"}), 400
+    return None
+
+#門市空間索引（Grid Index）+ 距離引擎（NumPy 向量化 Haversine）
+# 地圖每次移動中心/半徑都會打 /api/stores，把門市依經緯度切成固定大小的格子，
+# 半徑查詢只需檢查與外接矩形重疊的格子，不必掃過全部門市。
+# 門市座標另外存成連續的 float64 陣列（預先轉弧度、快取 cos(lat)），
+# 候選門市的距離一次向量化算完；/api/stores、spotlight、搜尋、AI 推薦都走同一套。
+GRID_CELL_DEG = 0.02   # 格子邊長 (度)，約 2.2 公里
+EARTH_RADIUS_KM = 6371.0
+
+store_geo_rows = []          # 依索引排列的門市 dict
+store_geo_index = {}         # store id -> 索引
+store_grid = defaultdict(list)   # (lat_cell, lng_cell) -> [索引]
+_store_geo_arrays = None     # (lat_rad, lng_rad, cos_lat)，新增門市後延遲重建
+store_grid_lock = threading.Lock()
+STORE_GRID_CHECK_INTERVAL = 10   # 秒；多久檢查一次 store_grid_version（外部寫入 stores 時重建）
+store_grid_version = None        # 目前格子索引對應的 store_grid_version
+store_grid_checked_at = 0.0
+
+def _grid_cell(lat, lng):
+    return int(math.floor(lat / GRID_CELL_DEG)), int(math.floor(lng / GRID_CELL_DEG))
+
+def _read_store_grid_version(conn):
+    try:
+        row = conn.execute("SELECT version FROM store_grid_version WHERE id = 1").fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+def build_store_grid():
+    """從資料庫載入所有門市，重建格子索引與座標陣列（啟動時、以及偵測到 stores 有外部寫入時）。"""
+    global store_geo_rows, store_geo_index, store_grid, _store_geo_arrays, store_grid_version
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        version = _read_store_grid_version(conn)
+        rows = conn.execute(
+            "SELECT id, name, address, latitude, longitude, brand FROM stores "
+            "WHERE latitude IS NOT NULL AND longitude IS NOT NULL ORDER BY id"
+        ).fetchall()
+        conn.close()
+    except Exception as e:
+        print(f"[ERROR] 建立門市空間索引失敗: {e}")
+        return
+
+    geo_rows = [dict(r) for r in rows]
+    geo_index = {}
+    grid = defaultdict(list)
+    for i, r in enumerate(geo_rows):
+        geo_index[r["id"]] = i
+        grid[_grid_cell(r["latitude"], r["longitude"])].append(i)
+
+    with store_grid_lock:
+        store_geo_rows, store_geo_index, store_grid = geo_rows, geo_index, grid
+        _store_geo_arrays = None
+        store_grid_version = version
+    print(f"[INFO] 門市空間索引已建立，門市數:{len(geo_rows)}，格子數:{len(grid)}")
+
+def refresh_store_grid_if_changed():
+    """每 STORE_GRID_CHECK_INTERVAL 秒最多查一次版本號；stores 被改過（含匯入腳本）就重建格子索引。"""
+    global store_grid_checked_at
+    now = time.time()
+    if now - store_grid_checked_at < STORE_GRID_CHECK_INTERVAL:
+        return
+    store_grid_checked_at = now
+    with db_connection() as con:
+        version = _read_store_grid_version(con)
+    if version != store_grid_version:
+        build_store_grid()
+        bump_data_version("stores")
+
+def grid_add_store(store):
+    """新增門市時同步加入索引；store 需包含 id/name/address/latitude/longitude/brand。"""
+    global _store_geo_arrays
+    if store.get("latitude") is None or store.get("longitude") is None:
+        return
+    with store_grid_lock:
+        i = len(store_geo_rows)
+        store_geo_rows.append(dict(store))
+        store_geo_index[store["id"]] = i
+        store_grid[_grid_cell(store["latitude"], store["longitude"])].append(i)
+        _store_geo_arrays = None
+
+def _geo_arrays():
+    """取得 (lat_rad, lng_rad, cos_lat) 三個連續 float64 陣列。"""
+    global _store_geo_arrays
+    with store_grid_lock:
+        if _store_geo_arrays is None:
+            lat = np.radians(np.array([r["latitude"] for r in store_geo_rows], dtype=np.float64))
+            lng = np.radians(np.array([r["longitude"] for r in store_geo_rows], dtype=np.float64))
+            _store_geo_arrays = (lat, lng, np.cos(lat))
+        return _store_geo_arrays
+
+def haversine_batch(lat, lng, lat_rad, lng_rad, cos_lat):
+    """一次計算 (lat, lng) 到多個點的距離 (km)；點座標為弧度，cos_lat 為其 cos 值。"""
+    phi = math.radians(lat)
+    lam = math.radians(lng)
+    a = np.sin((lat_rad - phi) / 2) ** 2 + math.cos(phi) * cos_lat * np.sin((lng_rad - lam) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+def store_distances_km(lat, lng, store_ids):
+    """回傳 (lat, lng) 到指定門市的距離陣列 (km)；找不到座標的門市為 NaN。"""
+    refresh_store_grid_if_changed()
+    lat_rad, lng_rad, cos_lat = _geo_arrays()
+    idx = np.array([store_geo_index.get(int(sid), -1) for sid in store_ids], dtype=np.int64)
+    out = np.full(len(idx), np.nan)
+    ok = idx >= 0
+    if ok.any():
+        sel = idx[ok]
+        out[ok] = haversine_batch(lat, lng, lat_rad[sel], lng_rad[sel], cos_lat[sel])
+    return out
+
+def grid_stores_within(lat, lng, radius_km):
+    """
+    回傳距離 (lat, lng) 在 radius_km 內的門市，格式為 [(門市 dict, 距離 km)]，依門市 id 排序。
+    """
+    refresh_store_grid_if_changed()
+    min_lat, max_lat, min_lng, max_lng = _bbox(lat, lng, radius_km)
+    lat_lo, lng_lo = _grid_cell(min_lat, min_lng)
+    lat_hi, lng_hi = _grid_cell(max_lat, max_lng)
+
+    with store_grid_lock:
+        n_cells = (lat_hi - lat_lo + 1) * (lng_hi - lng_lo + 1)
+        if n_cells > len(store_grid):
+            # 查詢範圍比實際有門市的格子還多（例如超大半徑），直接掃有資料的格子
+            cells = [v for (ci, cj), v in store_grid.items()
+                     if lat_lo <= ci <= lat_hi and lng_lo <= cj <= lng_hi]
+        else:
+            cells = []
+            for ci in range(lat_lo, lat_hi + 1):
+                for cj in range(lng_lo, lng_hi + 1):
+                    cell = store_grid.get((ci, cj))
+                    if cell:
+                        cells.append(cell)
+        cand = np.fromiter((i for cell in cells for i in cell), dtype=np.int64)
+        rows = store_geo_rows
+
+    if cand.size == 0:
+        return []
+    lat_rad, lng_rad, cos_lat = _geo_arrays()
+    dist = haversine_batch(lat, lng, lat_rad[cand], lng_rad[cand], cos_lat[cand])
+    keep = dist <= radius_km
+    cand, dist = cand[keep], dist[keep]
+    # 索引順序即門市 id 順序（載入時 ORDER BY id，之後新增的 id 只會更大）
+    order = np.argsort(cand, kind="stable")
+    return [(rows[i], float(d)) for i, d in zip(cand[order], dist[order])]
+
+def stores_within_json(lat, lng, radius_km):
+    """半徑內門市距離表，轉成 {"store_id": distance_km} JSON，供 SQL 以 json_each() 聯結。"""
+    return json.dumps({str(s["id"]): d for s, d in grid_stores_within(lat, lng, radius_km)})
 
 #背景庫存模擬系統（核心特色）
 # 啟動庫存更新的背景執行緒，啟動一個常駐背景執行緒，不依賴使用者請求。
@@ -264,206 +653,809 @@ NOTIFICATION_COOLDOWN = 60 * 60 * 4
 notification_cache = {}
 cache_lock = threading.Lock()
 
-#庫存引擎
+#庫存引擎（整批以 NumPy 向量運算，不再逐筆迴圈）
+STOCK_RNG = np.random.default_rng()
+STOCK_LOG_SAMPLE = 5      # 每次 tick 只抽樣印出幾筆變化，避免大量商品時被 console I/O 拖慢
+# 增量模式：庫存常駐記憶體，只寫回有變動的列；偵測到其他連線寫入（匯入、後台修改）才重讀整張表
+STOCK_INCREMENTAL = True
+
+def _load_stock_arrays(con):
+    """讀出全部商品庫存，回傳 (ids, qty, store_ids) 三個 int64 陣列。"""
+    rows = con.execute("SELECT id, remaining_qty, store_id FROM products ORDER BY id").fetchall()
+    if not rows:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty.copy(), empty.copy()
+    arr = np.array([tuple(r) for r in rows], dtype=np.int64)
+    return arr[:, 0].copy(), arr[:, 1].copy(), arr[:, 2].copy()
+
+def _stock_tick(qty, now):
+    """
+    對整個庫存陣列模擬一個時間間隔：補貨時段先補貨，再一次抽出全部需求。
+    回傳 (new_qty, restocked 遮罩, 跌破安全庫存遮罩, 實際賣出量)。
+    """
+    base = qty
+    restocked = np.zeros(qty.shape, dtype=bool)
+    if (now.hour, now.minute) in RESTOCK_TIMES:
+        base = np.minimum(qty + RESTOCK_QTY, MAX_STOCK)
+        restocked = base != qty
+    demand = STOCK_RNG.integers(DEMAND_MIN, DEMAND_MAX + 1, size=qty.shape[0])
+    new_qty = np.maximum(base - demand, 0)
+    low = (new_qty > 0) & (new_qty <= SAFETY_STOCK) & (qty > SAFETY_STOCK)
+    return new_qty, restocked, low, base - new_qty
+
+def _log_stock_tick(ids, qty, new_qty, restocked):
+    changed = np.flatnonzero(new_qty != qty)
+    print(f"[INFO] 庫存 tick：補貨 {int(restocked.sum())} 件商品，變動 {changed.size} 件，"
+          f"淨變化 {int((new_qty - qty).sum())}")
+    if changed.size:
+        for i in STOCK_RNG.choice(changed, size=min(STOCK_LOG_SAMPLE, changed.size), replace=False):
+            print(f"    商品 {ids[i]} 庫存 {qty[i]} -> {new_qty[i]}")
+
+def _update_demand_stats(cur, ids, new_qty, sold, hour):
+    """
+    以 Welford 串流更新 demand_stats（每商品 × 小時一列，O(1) 空間、不必掃歷史）。
+    賣到 0 的商品這次需求被庫存截斷，不列入觀測。
+    UPDATE SET 右邊引用的都是更新前的值，所以一條 upsert 就能完成 Welford 的三個欄位。
+    """
+    observed = new_qty > 0
+    if not observed.any():
+        return
+    cur.execute("""
+        INSERT INTO demand_stats (product_id, hour, n, mean, m2)
+        SELECT CAST(j.key AS INTEGER), ?, 1, j.value, 0 FROM json_each(?) j WHERE true
+        ON CONFLICT(product_id, hour) DO UPDATE SET
+            n    = n + 1,
+            mean = mean + (excluded.mean - mean) / (n + 1),
+            m2   = m2 + (excluded.mean - mean) * (excluded.mean - (mean + (excluded.mean - mean) / (n + 1)))
+    """, [hour, json.dumps(dict(zip(ids[observed].tolist(), sold[observed].tolist())))])
+
+def _persist_stock(conn, ids, qty, new_qty, store_ids, low, sold, now):
+    """
+    把變動的庫存、門市彙總差額、低庫存通知與需求統計寫回 DB（同一個 transaction）。
+    回傳 (更新商品數, 通知數)；寫入失敗回傳 None。
+    """
+    if ids.size == 0:
+        return 0, 0
+    changed = new_qty != qty
+
+    # 商品庫存用一條 UPDATE ... FROM json_each(?) 整批寫回，取代逐筆 executemany
+    updates = json.dumps(dict(zip(ids[changed].tolist(), new_qty[changed].tolist())))
+
+    # 各門市庫存變化量，用來增量更新 store_stock_summary
+    sids, inverse = np.unique(store_ids[changed], return_inverse=True)
+    deltas = np.bincount(inverse, weights=(new_qty - qty)[changed], minlength=sids.size).astype(np.int64)
+    store_deltas = [(s, s, d) for s, d in zip(sids.tolist(), deltas.tolist()) if d]
+
+    with DB_LOCK:
+        try:
+            cur = conn.cursor()
+            # 自己的寫回不算外部寫入（見 _m013_products_version）
+            cur.execute("UPDATE products_version SET tick_writing = 1 WHERE id = 1")
+            cur.execute("""
+                UPDATE products SET remaining_qty = j.value
+                FROM json_each(?) j
+                WHERE products.id = CAST(j.key AS INTEGER)
+            """, [updates])
+
+            # 彙總表還沒有這間門市時（啟動後才有商品），直接以目前庫存加總補上
+            cur.executemany("""
+                INSERT INTO store_stock_summary (store_id, total_qty)
+                SELECT ?, COALESCE(SUM(remaining_qty), 0) FROM products WHERE store_id = ?
+                ON CONFLICT(store_id) DO UPDATE SET total_qty = total_qty + ?
+            """, store_deltas)
+
+            # 低庫存通知；商品名稱只需查跌破安全庫存的那幾筆
+            if low.any():
+                low_qty = dict(zip(ids[low].tolist(), new_qty[low].tolist()))
+                names = dict(cur.execute(
+                    "SELECT id, name FROM products WHERE id IN (SELECT value FROM json_each(?))",
+                    [json.dumps(list(low_qty))]
+                ).fetchall())
+                cur.executemany(
+                    "INSERT INTO notifications (user_id, message, product_id) VALUES (?,?,?)",
+                    [(0, f"注意！商品「{names.get(pid)}」庫存已低於安全庫存 ({SAFETY_STOCK}件)，目前剩餘 {q} 件。", pid)
+                     for pid, q in low_qty.items()]
+                )
+
+            # 需求統計（逐分鐘的庫存軌跡由 record_stock_history 壓縮存放）
+            _update_demand_stats(cur, ids, new_qty, sold, now.hour)
+            cur.execute("UPDATE products_version SET tick_writing = 0 WHERE id = 1")
+            conn.commit()
+        except Exception as e:
+            import traceback
+            print(f"[FATAL ERROR] 批次寫入失敗: {e}")
+            traceback.print_exc() # 輸出完整的錯誤堆疊，幫助偵錯
+            # 確保發生錯誤時資料庫回滾，保持一致性
+            try: conn.rollback()
+            except: pass
+            return None
+    return int(changed.sum()), int(low.sum())
+
+#庫存歷史（分鐘值壓縮存放，逐層彙總成每小時 / 每日）
+HISTORY_MISSING = 0xFFFFFFFF             # 該分鐘沒有資料
+HISTORY_FLUSH_MINUTES = 15               # 緩衝的分鐘值每隔幾分鐘寫回一次（換小時也會寫）
+HISTORY_MINUTE_RETENTION_DAYS = 7        # 分鐘值保留天數，之後只留每小時彙總
+HISTORY_HOURLY_RETENTION_DAYS = 90       # 每小時彙總保留天數，之後只留每日彙總
+HISTORY_DAILY_RETENTION_DAYS = 730
+# 目前這個小時的分鐘值，只有 update_stock() 執行緒會寫；讀取端（/api/stock_history）用 history_lock 保護
+history_buffer = {"hour": None, "ids": None, "minutes": None, "pending": 0}
+history_lock = threading.Lock()
+
+def _pack_minutes(row):
+    """60 個分鐘值 -> 有值遮罩 (8 bytes) + 有值部分的差分 (int32)，再以 zlib 壓縮；約 70 bytes/小時。"""
+    present = row != HISTORY_MISSING
+    values = row[present].astype(np.int64)
+    deltas = np.diff(values, prepend=0).astype("<i4")
+    return zlib.compress(np.packbits(present, bitorder="little").tobytes() + deltas.tobytes())
+
+def _unpack_minutes(blob):
+    raw = zlib.decompress(blob)
+    present = np.unpackbits(np.frombuffer(raw[:8], dtype=np.uint8), bitorder="little")[:60].astype(bool)
+    row = np.full(60, HISTORY_MISSING, dtype=np.uint32)
+    row[present] = np.cumsum(np.frombuffer(raw[8:], dtype="<i4"))
+    return row
+
+def _hour_start(hour):
+    return datetime.fromtimestamp(hour * 3600)
+
+def _flush_stock_history(conn):
+    """把緩衝的分鐘值與該小時彙總 upsert 到 stock_history；同一小時已有資料（重啟、重讀後）就合併。"""
+    buf = history_buffer
+    if buf["hour"] is None or buf["ids"].size == 0:
+        return
+    ids, minutes, hour = buf["ids"], buf["minutes"].copy(), buf["hour"]
+    index = {pid: i for i, pid in enumerate(ids.tolist())}
+
+    for pid, blob in conn.execute(
+        "SELECT product_id, qty FROM stock_history WHERE hour = ? AND product_id IN (SELECT value FROM json_each(?))",
+        [hour, json.dumps(ids.tolist())]
+    ):
+        if blob is not None:
+            i = index[pid]
+            minutes[i] = np.where(minutes[i] == HISTORY_MISSING, _unpack_minutes(blob), minutes[i])
+
+    present = minutes != HISTORY_MISSING
+    counts = present.sum(axis=1)
+    values = minutes.astype(np.int64)
+    mins = np.where(present, values, np.iinfo(np.int64).max).min(axis=1)
+    maxs = np.where(present, values, -1).max(axis=1)
+    avgs = np.where(present, values, 0).sum(axis=1) / np.maximum(counts, 1)
+    lasts = values[np.arange(len(ids)), 59 - np.argmax(present[:, ::-1], axis=1)]
+
+    rows = [(pid, hour, _pack_minutes(minutes[i]), int(mins[i]), int(maxs[i]), float(avgs[i]), int(lasts[i]))
+            for i, pid in enumerate(ids.tolist()) if counts[i]]
+    conn.executemany("""
+        INSERT INTO stock_history (product_id, hour, qty, min_qty, max_qty, avg_qty, last_qty)
+        VALUES (?,?,?,?,?,?,?)
+        ON CONFLICT(product_id, hour) DO UPDATE SET
+            qty = excluded.qty, min_qty = excluded.min_qty, max_qty = excluded.max_qty,
+            avg_qty = excluded.avg_qty, last_qty = excluded.last_qty
+    """, rows)
+    conn.commit()
+    buf["pending"] = 0
+
+def _rollup_stock_history(conn, day):
+    """把某一天的每小時彙總併成每日彙總，並清掉超過保留期限的資料。"""
+    start = int(datetime(day.year, day.month, day.day).timestamp()) // 3600
+    conn.execute("""
+        INSERT OR REPLACE INTO stock_history_daily (product_id, day, min_qty, max_qty, avg_qty, last_qty)
+        SELECT h.product_id, ?, MIN(h.min_qty), MAX(h.max_qty), AVG(h.avg_qty),
+               (SELECT l.last_qty FROM stock_history l
+                WHERE l.product_id = h.product_id AND l.hour >= ? AND l.hour < ?
+                ORDER BY l.hour DESC LIMIT 1)
+        FROM stock_history h
+        WHERE h.hour >= ? AND h.hour < ?
+        GROUP BY h.product_id
+    """, [day.isoformat(), start, start + 24, start, start + 24])
+
+    now_hour = int(time.time()) // 3600
+    conn.execute("UPDATE stock_history SET qty = NULL WHERE hour < ? AND qty IS NOT NULL",
+                 [now_hour - HISTORY_MINUTE_RETENTION_DAYS * 24])
+    conn.execute("DELETE FROM stock_history WHERE hour < ?", [now_hour - HISTORY_HOURLY_RETENTION_DAYS * 24])
+    conn.execute("DELETE FROM stock_history_daily WHERE day < ?",
+                 [(day - timedelta(days=HISTORY_DAILY_RETENTION_DAYS)).isoformat()])
+    conn.commit()
+    print(f"[INFO] 庫存歷史 {day} 已彙總成每日資料")
+
+def record_stock_history(conn, ids, qty, now):
+    """每次 tick 後記下各商品這一分鐘的庫存；換小時（或商品清單改變）時寫回，換日時做每日彙總。"""
+    buf = history_buffer
+    hour = int(now.timestamp()) // 3600
+    try:
+        with history_lock:
+            if buf["hour"] is not None and (buf["hour"] != hour or not np.array_equal(buf["ids"], ids)):
+                _flush_stock_history(conn)
+                previous_day = _hour_start(buf["hour"]).date()
+                buf["hour"] = None
+                if previous_day != now.date():
+                    _rollup_stock_history(conn, previous_day)
+            if buf["hour"] is None:
+                buf.update(hour=hour, ids=ids.copy(), pending=0,
+                           minutes=np.full((ids.size, 60), HISTORY_MISSING, dtype=np.uint32))
+            buf["minutes"][:, now.minute] = qty
+            buf["pending"] += 1
+            if buf["pending"] >= HISTORY_FLUSH_MINUTES:
+                _flush_stock_history(conn)
+    except Exception as e:
+        print(f"[ERROR] 庫存歷史寫入失敗: {e}")
+        try: conn.rollback()
+        except: pass
+
+def stock_history(pid, start, end, resolution="auto"):
+    """
+    商品庫存在 [start, end) 的歷史。resolution：minute / hour / day / auto
+    （auto：一天內用分鐘值、31 天內用每小時彙總，其餘用每日彙總）。
+    回傳 (resolution, [dict])；分鐘值為 {"t", "qty"}，彙總為 {"t", "min", "max", "avg", "last"}。
+    """
+    if resolution == "auto":
+        span = end - start
+        resolution = "minute" if span <= timedelta(days=1) else "hour" if span <= timedelta(days=31) else "day"
+    start_hour, end_hour = int(start.timestamp()) // 3600, int(end.timestamp()) // 3600 + 1
+
+    if resolution == "day":
+        rows = query_db(
+            "SELECT day, min_qty, max_qty, avg_qty, last_qty FROM stock_history_daily "
+            "WHERE product_id = ? AND day >= ? AND day <= ? ORDER BY day",
+            [pid, start.date().isoformat(), end.date().isoformat()]
+        )
+        return resolution, [{"t": r["day"], "min": r["min_qty"], "max": r["max_qty"],
+                             "avg": round(r["avg_qty"], 2), "last": r["last_qty"]} for r in rows]
+
+    rows = query_db(
+        "SELECT hour, qty, min_qty, max_qty, avg_qty, last_qty FROM stock_history "
+        "WHERE product_id = ? AND hour >= ? AND hour < ? ORDER BY hour",
+        [pid, start_hour, end_hour]
+    )
+    if resolution == "hour":
+        return resolution, [{"t": _hour_start(r["hour"]).isoformat(), "min": r["min_qty"], "max": r["max_qty"],
+                             "avg": round(r["avg_qty"], 2), "last": r["last_qty"]} for r in rows]
+
+    hours = {r["hour"]: _unpack_minutes(r["qty"]) for r in rows if r["qty"] is not None}
+    # 還在緩衝區（尚未寫回）的分鐘值也算進來
+    with history_lock:
+        buf = history_buffer
+        if buf["hour"] is not None and start_hour <= buf["hour"] < end_hour:
+            i = np.flatnonzero(buf["ids"] == pid)
+            if i.size:
+                row = buf["minutes"][i[0]]
+                old = hours.get(buf["hour"])
+                hours[buf["hour"]] = row.copy() if old is None else np.where(row == HISTORY_MISSING, old, row)
+
+    points = []
+    for hour in sorted(hours):
+        base = _hour_start(hour)
+        for minute in np.flatnonzero(hours[hour] != HISTORY_MISSING).tolist():
+            t = base + timedelta(minutes=minute)
+            if start <= t < end:
+                points.append({"t": t.isoformat(), "qty": int(hours[hour][minute])})
+    return resolution, points
+
+def _read_products_version(conn):
+    return conn.execute("SELECT version FROM products_version WHERE id = 1").fetchone()[0]
+
 def update_stock():
+    # products_version 只在其他連線改到 products 時前進（收藏、通知、jobs 等寫入不算），自己的寫回也不算
+    conn = _new_db_connection()
+    ids = qty = store_ids = None
+    products_version = None
+
     while True:
         time.sleep(UPDATE_INTERVAL) #每 UPDATE_INTERVAL 秒執行一次
         now = datetime.now()
 
-        # 為了避免長時間持有 DB_LOCK，先在外部計算好所有更新
-        products_to_update = []
-        notifications_to_add = []
-        
         try:
-            # 讀取產品清單（不加鎖）
-            conn = sqlite3.connect(DB_PATH, timeout=0.5)
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, remaining_qty, name FROM products")
-            products = cursor.fetchall()
-            conn.close()
+            version = _read_products_version(conn)
+            if not STOCK_INCREMENTAL or ids is None or version != products_version:
+                if products_version is not None and version != products_version:
+                    # 外部改了商品（匯入、手動修改）：門市彙總跟著重算；門市格子索引另有 store_grid_version
+                    with DB_LOCK:
+                        refresh_summary_tables(conn)
+                    bump_data_version("products")
+                    bump_data_version("stock")
+                ids, qty, store_ids = _load_stock_arrays(conn)
+                products_version = version
+                invalidate_forecast_cache()
+                invalidate_item_features()
         except Exception as e:
             print(f"[ERROR] 讀取產品清單失敗: {e}")
             continue
 
-        # 計算補貨和消耗
-        for pid, qty, name in products:
-            new_qty = qty
-            
-            # 補貨檢查
-            for rh, rm in RESTOCK_TIMES:
-                if now.hour == rh and now.minute == rm:
-                    new_qty = min(qty + RESTOCK_QTY, MAX_STOCK)
-                    if new_qty != qty:
-                         print(f"[補貨] 商品 {pid} 補貨 {new_qty - qty} 件，庫存 = {new_qty} (預計)")
-
-            # 消耗檢查
-            demand = random.randint(DEMAND_MIN, DEMAND_MAX)
-            # 如果補貨沒有發生，就使用原始的 qty 來計算消耗，避免重複計算
-            base_qty = new_qty if new_qty != qty else qty 
-            final_qty = max(0, base_qty - demand)
-
-            # 準備更新
-            if final_qty != qty:
-                products_to_update.append((final_qty, pid))
-                print(f"[消耗] 商品 {pid} 消耗 {base_qty - final_qty} 件，庫存 = {final_qty} (預計)")
-
-            # 低庫存通知（使用最終庫存判斷）
-            if final_qty > 0 and final_qty <= SAFETY_STOCK and qty > SAFETY_STOCK:
-                msg = f"注意！商品「{name}」庫存已低於安全庫存 ({SAFETY_STOCK}件)，目前剩餘 {final_qty} 件。"
-                notifications_to_add.append((0, msg, pid))
-
-        # **STEP 3: 在一個單一事務中寫入所有資料** 一次 transaction 寫回 DB
-        if products_to_update or notifications_to_add:
-            with DB_LOCK:
-                try:
-                    conn = sqlite3.connect(DB_PATH, timeout=5.0) # 增加 timeout
-                    cur = conn.cursor()
-
-                    # 批量更新庫存
-                    cur.executemany("UPDATE products SET remaining_qty=? WHERE id=?", products_to_update)
-                    
-                    # 批量新增通知
-                    cur.executemany(
-                        "INSERT INTO notifications (user_id, message, product_id) VALUES (?,?,?)",
-                        notifications_to_add
-                    )
-
-                    conn.commit()
-                    print(f"[INFO] 本次批次更新完成。產品數:{len(products_to_update)}，通知數:{len(notifications_to_add)}")
-                except Exception as e:
-                    # **請將此處修改成更詳細的輸出**
-                    import traceback
-                    print(f"[FATAL ERROR] 批次寫入失敗: {e}")
-                    traceback.print_exc() # 輸出完整的錯誤堆疊，幫助偵錯
-                    # 確保發生錯誤時資料庫回滾，保持一致性
-                    try: conn.rollback() 
-                    except: pass
-                finally:
-                    try: conn.close()
-                    except: pass
+        new_qty, restocked, low, sold = _stock_tick(qty, now)
+        _log_stock_tick(ids, qty, new_qty, restocked)
+        result = _persist_stock(conn, ids, qty, new_qty, store_ids, low, sold, now)
+        if result is None:
+            ids = None   # 寫入失敗，記憶體內的庫存不可信，下次重讀
+            continue
+        changed = new_qty != qty
+        invalidate_forecast_cache(ids[changed].tolist())
+        if changed.any():
+            invalidate_item_features()   # 門市剩餘量變了，推薦排序跟著變
+            bump_data_version("stock")   # products.remaining_qty 與 store_stock_summary
+        if low.any():
+            bump_data_version("notifications", 0)   # 低庫存通知寫給 user_id 0
+        qty = new_qty
+        record_stock_history(conn, ids, qty, now)
+        n_updated, n_notified = result
+        if n_updated or n_notified:
+            print(f"[INFO] 本次批次更新完成。產品數:{n_updated}，通知數:{n_notified}")
 
 #蒙地卡羅售罄預測（學術亮點），預測商品「大約幾小時後賣完」
-def _forecast_stock(pid):
+MAX_SIMULATION_MINUTES = 48 * 60   # 最長模擬 48 小時
+FORECAST_CHUNK_STEPS = 128         # 每次抽一塊需求矩陣，全部模擬售罄就提早結束
+FORECAST_ANALYTIC_MIN_QTY = 200    # auto 模式下，庫存達此數量改用解析近似
+FORECAST_RNG = np.random.default_rng()
+
+def simulate_sellout_minutes(qty, n_sims=NUM_SIMULATIONS, rng=None, profile=None):
     """
-    根據蒙地卡羅模擬預測商品售罄時間 (小時)。
-    
-    Return:
-      > 0: 預計售罄時間 (小時), 
-      = 0: 庫存已為 0, 
-      < 0: 預測失敗或商品不存在 (-1)
+    以 NumPy 一次模擬 n_sims 條需求路徑，回傳每條路徑的售罄時間 (分鐘)。
+    需求一塊一塊抽 (n_sims × FORECAST_CHUNK_STEPS)，用累積和找第一個 >= qty 的步數；
+    超過 MAX_SIMULATION_MINUTES 仍未售罄記為 MAX_SIMULATION_MINUTES；庫存 <= 0 記為 0（已售完）。
+    qty 可以是多個庫存量：所有庫存量共用同一批需求路徑，回傳 (len(qty), n_sims)。
+    profile=(每步平均, 每步標準差) 時改用商品自己的需求模型（常態取整、截在 0），
+    否則每步需求為 [DEMAND_MIN, DEMAND_MAX] 均勻整數。
     """
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    # 1. 取得當前庫存
-    cursor.execute("SELECT remaining_qty FROM products WHERE id=?", (pid,))
-    product_row = cursor.fetchone()
-    conn.close()
-
-    if not product_row:
-        return -1  # 商品不存在
-
-    current_stock = product_row["remaining_qty"]
+    rng = rng or FORECAST_RNG
+    qtys = np.atleast_1d(np.asarray(qty, dtype=np.int64))
+    max_steps = int(MAX_SIMULATION_MINUTES // SIMULATION_INTERVAL_MINUTES)
+    result = np.full((qtys.size, n_sims), float(MAX_SIMULATION_MINUTES))
+    target = qtys.max() if qtys.size else 0
+    alive = np.arange(n_sims)                 # 最大庫存量還沒售罄的模擬
+    sold = np.zeros(n_sims, dtype=np.int64)   # 各模擬目前累積的需求量
+    step = 0
+
+    while alive.size and step < max_steps:
+        n = min(FORECAST_CHUNK_STEPS, max_steps - step)
+        if profile is None:
+            demand = rng.integers(DEMAND_MIN, DEMAND_MAX + 1, size=(alive.size, n), dtype=np.int32)
+        else:
+            mean, std = profile
+            demand = np.rint(rng.normal(mean[step:step + n], std[step:step + n], size=(alive.size, n)))
+            demand = np.maximum(demand, 0).astype(np.int32)
+        cum = np.cumsum(demand, axis=1, dtype=np.int64) + sold[:, None]
+        # 需求非負，累積和單調遞增：這塊開頭未達、最後一格達到，就代表在這塊內售罄
+        for k, q in enumerate(qtys):
+            crossed = (sold < q) & (cum[:, -1] >= q)
+            if crossed.any():
+                first = np.argmax(cum[crossed] >= q, axis=1)
+                result[k, alive[crossed]] = (step + first + 1) * SIMULATION_INTERVAL_MINUTES
+        done = cum[:, -1] >= target
+        sold = cum[~done, -1]
+        alive = alive[~done]
+        step += n
+    result[qtys <= 0] = 0.0
+    return result if np.ndim(qty) else result[0]
+
+def analytic_sellout_minutes(qty, quantiles=(0.5,), profile=None):
+    """
+    解析近似：每步需求為 [DEMAND_MIN, DEMAND_MAX] 均勻整數，n 步後累積需求近似常態
+    (mean = nμ, var = nσ²)。售罄步數 T 滿足 P(T <= n) = P(S_n >= qty)，
+    對每個分位數 p 解 nμ - z_p·σ·√n >= qty - 0.5（連續性修正）的最小 n。
+    qty 可以是陣列，回傳 (len(qty), len(quantiles))。
+    profile=(每步平均, 每步標準差) 時每步參數不同，改用累積平均/變異數逐步找第一個滿足的 n。
+    庫存 <= 0 回傳 0，與 simulate_sellout_minutes 一致。
+    """
+    empty = (np.asarray(qty) <= 0)[..., None]
+    c = np.maximum(np.asarray(qty, dtype=float) - 0.5, 0.0)[..., None]
+    z = np.array([NormalDist().inv_cdf(p) for p in quantiles])
+    if profile is not None:
+        mean, std = profile
+        cum_mean, cum_sd = np.cumsum(mean), np.sqrt(np.cumsum(std ** 2))
+        ok = cum_mean - z[:, None] * cum_sd >= c[..., None]    # (..., 分位數, 步數)
+        steps = np.argmax(ok, axis=-1) + 1
+        minutes = np.where(ok.any(axis=-1), np.minimum(steps * SIMULATION_INTERVAL_MINUTES, MAX_SIMULATION_MINUTES),
+                           float(MAX_SIMULATION_MINUTES))
+        return np.where(empty, 0.0, minutes)
+
+    mu = (DEMAND_MIN + DEMAND_MAX) / 2
+    sigma = math.sqrt(((DEMAND_MAX - DEMAND_MIN + 1) ** 2 - 1) / 12)
+    if mu <= 0:
+        return np.where(empty, 0.0, np.full(c.shape[:-1] + (len(quantiles),), float(MAX_SIMULATION_MINUTES)))
+    u = (z * sigma + np.sqrt((z * sigma) ** 2 + 4 * mu * c)) / (2 * mu)
+    steps = np.maximum(np.ceil(u ** 2), 1)
+    return np.where(empty, 0.0, np.minimum(steps * SIMULATION_INTERVAL_MINUTES, MAX_SIMULATION_MINUTES))
+
+def sellout_quantiles(qty, quantiles=(0.5,), mode="auto", n_sims=NUM_SIMULATIONS, profile=None):
+    """
+    售罄時間 (分鐘) 的分位數。mode:
+      "mc"       NumPy 蒙地卡羅
+      "analytic" 常態 / renewal 近似（不抽樣，大庫存也是 O(1)）
+      "auto"     庫存 >= FORECAST_ANALYTIC_MIN_QTY 時用 analytic，否則 mc
+    qty 為單一數字時回傳 (len(quantiles),)；為陣列時回傳 (len(qty), len(quantiles))，
+    其中 mc 的部分共用同一批需求路徑。profile 見 simulate_sellout_minutes。
+    """
+    if mode not in ("auto", "mc", "analytic"):
+        raise ValueError(f"未知的預測模式: {mode}")
+    qtys = np.atleast_1d(np.asarray(qty, dtype=np.int64))
+    if mode == "auto":
+        analytic = qtys >= FORECAST_ANALYTIC_MIN_QTY
+    else:
+        analytic = np.full(qtys.shape, mode == "analytic")
+
+    result = np.empty((qtys.size, len(quantiles)))
+    if analytic.any():
+        result[analytic] = analytic_sellout_minutes(qtys[analytic], quantiles, profile)
+    if (~analytic).any():
+        sims = simulate_sellout_minutes(qtys[~analytic], n_sims, profile=profile)
+        result[~analytic] = np.quantile(sims, quantiles, axis=1).T
+    return result if np.ndim(qty) else result[0]
+
+#售罄預測快取（LRU + TTL）
+# ("qty", 庫存量, 模式, 需求模型參數) -> 小時：同樣的庫存量在同一個需求模型下結果相同
+# ("pid", 商品 id) -> 庫存量：update_stock() 改到的商品會被剔除，其餘呼叫不必查 DB
+# ("demand", 商品 id) -> 商品需求模型；("product", 商品 id, 庫存量, 小時, ...) -> 用該模型算出的小時
+FORECAST_CACHE_SIZE = 4096
+FORECAST_CACHE_TTL = 10 * 60   # 秒
+forecast_cache = OrderedDict()  # key -> (到期時間, 值)
+forecast_cache_lock = threading.Lock()
+
+def _forecast_model_key(mode):
+    return (mode, DEMAND_MIN, DEMAND_MAX, SIMULATION_INTERVAL_MINUTES, MAX_SIMULATION_MINUTES,
+            NUM_SIMULATIONS, FORECAST_ANALYTIC_MIN_QTY)
+
+def _forecast_cache_get(key):
+    with forecast_cache_lock:
+        hit = forecast_cache.get(key)
+        if hit is None:
+            return None
+        if hit[0] < time.time():
+            del forecast_cache[key]
+            return None
+        forecast_cache.move_to_end(key)
+        return hit[1]
+
+def _forecast_cache_put(key, value):
+    with forecast_cache_lock:
+        forecast_cache[key] = (time.time() + FORECAST_CACHE_TTL, value)
+        forecast_cache.move_to_end(key)
+        while len(forecast_cache) > FORECAST_CACHE_SIZE:
+            forecast_cache.popitem(last=False)
+
+def invalidate_forecast_cache(pids=None):
+    """剔除指定商品的庫存快取；pids=None 表示全部商品（例如偵測到外部寫入）。"""
+    with forecast_cache_lock:
+        if pids is None:
+            for key in [k for k in forecast_cache if k[0] == "pid"]:
+                del forecast_cache[key]
+        else:
+            for pid in pids:
+                forecast_cache.pop(("pid", pid), None)
+
+#售罄時間查表：庫存上限 MAX_STOCK，同一需求模型下只有 0..MAX_STOCK 共 MAX_STOCK+1 種輸入
+FORECAST_BANDS = (0.5, 0.1, 0.9)   # 中位數、p10、p90
+sellout_table = None               # (模型 key, float32 陣列 (MAX_STOCK+1, 3)，單位分鐘)
+sellout_table_lock = threading.Lock()
+
+def build_sellout_table():
+    """0..MAX_STOCK 每個庫存量的售罄時間分位數，一次共用同一批模擬算完；需求參數改變時重算。"""
+    global sellout_table
+    model = _forecast_model_key("mc")
+    with sellout_table_lock:
+        if sellout_table is not None and sellout_table[0] == model:
+            return sellout_table
+        t0 = time.time()
+        minutes = np.zeros((MAX_STOCK + 1, len(FORECAST_BANDS)), dtype=np.float32)
+        minutes[1:] = sellout_quantiles(np.arange(1, MAX_STOCK + 1), FORECAST_BANDS, "mc")
+        sellout_table = (model, minutes)
+        print(f"[INFO] 售罄時間查表已建立，庫存 0..{MAX_STOCK}，耗時 {time.time() - t0:.2f}s")
+        return sellout_table
+
+def _sellout_table_minutes():
+    """目前需求模型的查表；還沒建好或模型已變時先在背景重算，這次回傳 None 走一般路徑。"""
+    table = sellout_table
+    if table is not None and table[0] == _forecast_model_key("mc"):
+        return table[1]
+    if not sellout_table_lock.locked():
+        threading.Thread(target=build_sellout_table, daemon=True).start()
+    return None
 
-    # 2. 庫存為 0，回傳 0
-    if current_stock == 0:
-        return 0
+def _minutes_to_hours(minutes):
+    # 超過 48 小時回傳一個大數字999 (前端會顯示「庫存充足」)
+    return 999.0 if minutes >= MAX_SIMULATION_MINUTES else round(minutes / 60, 1)
 
-    # 3. 蒙地卡羅模擬
-    sell_out_times_minutes = []
-    MAX_SIMULATION_MINUTES = 48 * 60 # 最長模擬 48 小時
-    
-    for _ in range(NUM_SIMULATIONS):
-        sim_stock = current_stock
-        time_elapsed_minutes = 0
-        
-        while sim_stock > 0 and time_elapsed_minutes < MAX_SIMULATION_MINUTES:
-            # 每個時間間隔內的隨機需求
-            demand = random.randint(DEMAND_MIN, DEMAND_MAX)
-            
-            sim_stock -= demand
-            time_elapsed_minutes += SIMULATION_INTERVAL_MINUTES
-        
-        if sim_stock <= 0:
-            # 庫存耗盡，記錄時間 (使用線性插值可以更準確，但為簡潔使用步進時間)
-            sell_out_times_minutes.append(time_elapsed_minutes)
+def _sellout_hours(qtys, mode="auto"):
+    """
+    庫存量 -> (中位數, p10, p90) 售罄時間 (小時)。0 或負庫存回傳 (0, 0, 0)。
+    auto/mc 且庫存在 0..MAX_STOCK 內直接查表；其他情況走 LRU 快取，缺的才模擬。
+    """
+    model = _forecast_model_key(mode)
+    table = _sellout_table_minutes() if mode in ("auto", "mc") else None
+    hours = {q: (0, 0, 0) for q in qtys if q <= 0}
+    missing = []
+    for q in sorted({q for q in qtys if q > 0}):
+        if table is not None and q <= MAX_STOCK:
+            hours[q] = tuple(_minutes_to_hours(float(m)) for m in table[q])
+            continue
+        cached = _forecast_cache_get(("qty", q, model))
+        if cached is None:
+            missing.append(q)
         else:
-            # 超過最大模擬時間仍未售罄
-            sell_out_times_minutes.append(MAX_SIMULATION_MINUTES)
-
-    # 4. 計算中位數售罄時間 (避免極端值影響)，並轉換成小時
-    if not sell_out_times_minutes:
-        return -1 # 預測失敗
+            hours[q] = cached
+    if missing:
+        bands = sellout_quantiles(missing, FORECAST_BANDS, mode)
+        for q, row in zip(missing, bands.tolist()):
+            hours[q] = tuple(_minutes_to_hours(m) for m in row)
+            _forecast_cache_put(("qty", q, model), hours[q])
+    return hours
+
+#商品自己的需求模型（來自 update_stock() 寫入的 demand_stats）
+DEMAND_MIN_OBS = 30   # 某小時的觀測數少於此值時，該小時沿用全域均勻需求
+
+def _demand_profiles(pids):
+    """
+    {pid: (平均[24], 變異數[24])}，每小時一格；沒有任何一格達到 DEMAND_MIN_OBS 的商品不會出現在結果裡。
+    結果放進預測快取，TTL 內不重查 demand_stats。
+    """
+    profiles, missing = {}, []
+    for pid in pids:
+        cached = _forecast_cache_get(("demand", pid))
+        if cached is None:
+            missing.append(pid)
+        elif cached:
+            profiles[pid] = cached
+    if not missing:
+        return profiles
+
+    mu = (DEMAND_MIN + DEMAND_MAX) / 2
+    var = ((DEMAND_MAX - DEMAND_MIN + 1) ** 2 - 1) / 12
+    fetched = {}
+    rows = query_db(
+        "SELECT product_id, hour, n, mean, m2 FROM demand_stats "
+        "WHERE product_id IN (SELECT value FROM json_each(?)) AND n >= ?",
+        [json.dumps(missing), DEMAND_MIN_OBS]
+    )
+    for r in rows:
+        mean, variance = fetched.setdefault(r["product_id"], (np.full(24, mu), np.full(24, var)))
+        mean[r["hour"]] = r["mean"]
+        variance[r["hour"]] = r["m2"] / (r["n"] - 1)
+    for pid in missing:
+        _forecast_cache_put(("demand", pid), fetched.get(pid, False))
+    profiles.update(fetched)
+    return profiles
+
+def _step_profile(profile, now):
+    """把每小時的 (平均, 變異數) 展開成從 now 起每一步的 (平均, 標準差)。"""
+    mean, variance = profile
+    max_steps = int(MAX_SIMULATION_MINUTES // SIMULATION_INTERVAL_MINUTES)
+    minutes = now.minute + np.arange(max_steps) * SIMULATION_INTERVAL_MINUTES
+    hours = (now.hour + (minutes // 60).astype(np.int64)) % 24
+    return mean[hours], np.sqrt(variance[hours])
+
+def _product_sellout_hours(pid, qty, profile, mode, now):
+    """用商品自己的需求模型預測 (中位數, p10, p90) 小時；同商品同庫存在同一個小時內共用快取。"""
+    key = ("product", pid, qty, now.hour, _forecast_model_key(mode))
+    cached = _forecast_cache_get(key)
+    if cached is not None:
+        return cached
+    if mode == "auto":
+        mode = "analytic" if qty >= FORECAST_ANALYTIC_MIN_QTY else "mc"
+    bands = sellout_quantiles(qty, FORECAST_BANDS, mode, profile=_step_profile(profile, now))
+    hours = tuple(_minutes_to_hours(m) for m in bands.tolist())
+    _forecast_cache_put(key, hours)
+    return hours
+
+def _product_qtys(pids):
+    """{pid: remaining_qty}，先查快取，缺的一次用 json_each 查回來；不存在的商品不會出現在結果裡。"""
+    qty_by_id, missing = {}, []
+    for pid in pids:
+        cached = _forecast_cache_get(("pid", pid))
+        if cached is None:
+            missing.append(pid)
+        else:
+            qty_by_id[pid] = cached
+    if missing:
+        rows = query_db(
+            "SELECT id, remaining_qty FROM products WHERE id IN (SELECT value FROM json_each(?))",
+            [json.dumps(missing)]
+        )
+        for r in rows:
+            qty_by_id[r["id"]] = r["remaining_qty"]
+            _forecast_cache_put(("pid", r["id"]), r["remaining_qty"])
+    return qty_by_id
 
-    median_sell_out_minutes = np.median(sell_out_times_minutes)
+def _forecast_stock(pid, mode="auto"):
+    """
+    根據蒙地卡羅模擬（或解析近似）預測商品售罄時間 (小時)。
     
-    # 如果預計能撐超過 48 小時，回傳一個大數字999 (前端會顯示「庫存充足」)
-    if median_sell_out_minutes >= MAX_SIMULATION_MINUTES:
-        return 999.0
-
-    # 回傳結果，取一位小數
-    return round(median_sell_out_minutes / 60, 1)
+    Return:
+      > 0: 預計售罄時間 (小時), 
+      = 0: 庫存已為 0, 
+      < 0: 預測失敗或商品不存在 (-1)
+    """
+    return _forecast_batch([pid], mode)[pid][0]
 
-#推薦系統（Collaborative Filtering）
-# 收藏行為 → 商品相似度
-# 推薦系統相關函數
-def get_item_similarity_matrix():
+def _forecast_batch(pids, mode="auto"):
     """
-    從收藏清單中計算商品之間的餘弦相似度矩陣。
-    這個函數可以在應用程式啟動時或定時執行，以提升效能。
+    多個商品一起預測：一次查庫存，相同需求模型的商品共用一批模擬。
+    回傳 {pid: (中位數小時, p10, p90)}；商品不存在為 (-1, None, None)。
     """
-    try:
-        # 1. 取得使用者收藏資料
-        favorites = query_db("SELECT user_id, product_id FROM favorites")
-        print(f"從資料庫讀取的收藏資料: {favorites}")
-        if not favorites:
-            return None, None
+    qty_by_id = _product_qtys(pids)
+    profiles = _demand_profiles([pid for pid, q in qty_by_id.items() if q > 0])
+    # 沒有足夠觀測的商品仍用全域需求模型（查表 / 共用模擬）
+    hours = _sellout_hours([q for pid, q in qty_by_id.items() if pid not in profiles], mode)
+    now = datetime.now()
+
+    result = {}
+    for pid in pids:
+        if pid not in qty_by_id:
+            result[pid] = (-1, None, None)
+        elif pid in profiles:
+            result[pid] = _product_sellout_hours(pid, qty_by_id[pid], profiles[pid], mode, now)
+        else:
+            result[pid] = hours[qty_by_id[pid]]
+    return result
 
-        favorites_list = [dict(row) for row in favorites]
+#推薦系統（Collaborative Filtering）
+# 收藏行為 → 商品相似度：cos(i, j) = 同時收藏 i、j 的人數 / sqrt(收藏 i 人數 × 收藏 j 人數)
+# 使用者 × 商品收藏矩陣以 scipy.sparse CSR 存放，共同收藏次數 C = XᵀX 也是稀疏的（對角線 = 收藏人數），
+# 記憶體隨非零項成長；每個商品只保留前 RECO_NEIGHBORS 個相似商品（NumPy 陣列），查詢就是切一列。
+# 收藏新增/移除由背景執行緒增量更新：差異記在 overlay，只重算受影響商品那幾列，定期重建時併回 CSR。
+RECO_NEIGHBORS = 50                # 每個商品保留的相似商品數
+RECO_REBUILD_INTERVAL = 30 * 60    # 定期從 favorites 全量重建（多個 process 時各自的增量會在這裡對齊）
+reco_lock = threading.Lock()
+reco_state = None                  # 見 _build_reco_state
+reco_events = queue.Queue()
+
+def _build_reco_state(user_ids, product_ids):
+    """由收藏 (user_id, product_id) 建出 CSR 矩陣與每個商品的 top-k 相似陣列。"""
+    items, cols = np.unique(np.asarray(product_ids, dtype=np.int64), return_inverse=True)
+    users, rows = np.unique(np.asarray(user_ids, dtype=np.int64), return_inverse=True)
+    X = sp.csr_matrix((np.ones(len(cols), dtype=np.int32), (rows, cols)), shape=(users.size, items.size))
+    X.data[:] = 1                       # 重複的收藏只算一次
+    C = (X.T @ X).tocsr()               # 商品 × 商品共同收藏次數
+    C.sort_indices()
+
+    capacity = max(items.size, 16)
+    state = {
+        "X": X, "C": C, "counts": C.diagonal().astype(np.int64),
+        "users": {u: r for r, u in enumerate(users.tolist())},
+        "item_ids": np.concatenate([items, np.full(capacity - items.size, -1, dtype=np.int64)]),
+        "items": {p: r for r, p in enumerate(items.tolist())},
+        "n_items": items.size,
+        "nbr_ids": np.full((capacity, RECO_NEIGHBORS), -1, dtype=np.int64),     # 相似商品 id，不足補 -1
+        "nbr_scores": np.zeros((capacity, RECO_NEIGHBORS), dtype=np.float32),
+        "toggled": defaultdict(set),    # user_id -> 重建後狀態改變過的商品列（與 X 做 XOR）
+        "overlay": defaultdict(lambda: defaultdict(int)),   # 商品列 -> {商品列: C 的增減}
+    }
+    for r in range(items.size):
+        _reco_refresh_row(state, r)
+    return state
+
+def _reco_counts(state, rows):
+    """各商品列目前的收藏人數（C 的對角線 + overlay）。"""
+    counts = state["counts"]
+    result = np.zeros(len(rows), dtype=np.int64)
+    inside = rows < len(counts)
+    result[inside] = counts[rows[inside]]
+    overlay = state["overlay"]
+    if overlay:
+        for k, r in enumerate(rows.tolist()):
+            if r in overlay:
+                result[k] += overlay[r].get(r, 0)
+    return result
 
-        # 2. 轉換為 Pandas DataFrame
-        df = pd.DataFrame(favorites_list)
-        
-        # 3. 建立使用者-商品交互矩陣
-        user_item_matrix = df.pivot_table(
-            #favorites 表 → 使用者 × 商品矩陣
-            index='product_id', 
-            columns='user_id', 
-            aggfunc=lambda x: 1, 
-            fill_value=0
-        )
-        
-        # 4. 計算餘弦相似度，Cosine similarity 是對「商品向量」算的
-        item_similarity_matrix = cosine_similarity(user_item_matrix)
-        
-        # 5. 轉換回 DataFrame 以便後續查找
-        item_similarity_df = pd.DataFrame(
-            item_similarity_matrix,
-            index=user_item_matrix.index,
-            columns=user_item_matrix.index
-        )
-        return item_similarity_df, user_item_matrix.index.tolist()
+def _reco_cooc_row(state, r):
+    """商品列 r 目前的共同收藏次數（CSR 那一列 + overlay），回傳 (列號陣列, 次數陣列)，不含自己。"""
+    C = state["C"]
+    if r < C.shape[0]:
+        idx = C.indices[C.indptr[r]:C.indptr[r + 1]]
+        val = C.data[C.indptr[r]:C.indptr[r + 1]].astype(np.int64)
+    else:
+        idx = val = np.empty(0, dtype=np.int64)
+    if r in state["overlay"]:
+        merged = dict(zip(idx.tolist(), val.tolist()))
+        for j, d in state["overlay"][r].items():
+            merged[j] = merged.get(j, 0) + d
+        idx = np.fromiter(merged.keys(), dtype=np.int64, count=len(merged))
+        val = np.fromiter(merged.values(), dtype=np.int64, count=len(merged))
+    keep = (idx != r) & (val > 0)
+    return idx[keep], val[keep]
+
+def _reco_refresh_row(state, r):
+    """重算商品列 r 的 top-k 相似陣列。"""
+    idx, co = _reco_cooc_row(state, r)
+    state["nbr_ids"][r] = -1
+    state["nbr_scores"][r] = 0
+    n_r = _reco_counts(state, np.array([r]))[0]
+    if idx.size == 0 or n_r <= 0:
+        return
+    scores = co / np.sqrt(n_r * _reco_counts(state, idx))
+    ids = state["item_ids"][idx]
+    if idx.size > RECO_NEIGHBORS:
+        top = np.argpartition(-scores, RECO_NEIGHBORS - 1)[:RECO_NEIGHBORS]
+        scores, ids = scores[top], ids[top]
+    order = np.lexsort((ids, -scores))      # 分數由高到低，同分依商品 id
+    state["nbr_ids"][r, :order.size] = ids[order]
+    state["nbr_scores"][r, :order.size] = scores[order]
+
+def _reco_item_row(state, pid):
+    """商品 id -> 列號；重建後才出現的商品配一個新列，陣列容量不夠就加倍。"""
+    r = state["items"].get(pid)
+    if r is not None:
+        return r
+    r = state["n_items"]
+    if r >= len(state["item_ids"]):
+        grow = len(state["item_ids"])
+        state["item_ids"] = np.concatenate([state["item_ids"], np.full(grow, -1, dtype=np.int64)])
+        state["nbr_ids"] = np.vstack([state["nbr_ids"], np.full((grow, RECO_NEIGHBORS), -1, dtype=np.int64)])
+        state["nbr_scores"] = np.vstack([state["nbr_scores"], np.zeros((grow, RECO_NEIGHBORS), dtype=np.float32)])
+    state["item_ids"][r] = pid
+    state["items"][pid] = r
+    state["n_items"] = r + 1
+    return r
 
+def _reco_user_rows(state, uid):
+    """使用者目前收藏的商品列（CSR 那一列 XOR 重建後的變動）。"""
+    X, r = state["X"], state["users"].get(uid)
+    base = set(X.indices[X.indptr[r]:X.indptr[r + 1]].tolist()) if r is not None else set()
+    return base ^ state["toggled"].get(uid, set())
+
+def rebuild_recommender():
+    """從 favorites 全量重建；在區域變數算完再一次換上，重建期間查詢仍用舊資料。"""
+    global reco_state
+    rows = query_db("SELECT user_id, product_id FROM favorites")
+    state = _build_reco_state([r["user_id"] for r in rows], [r["product_id"] for r in rows])
+    with reco_lock:
+        reco_state = state
+    invalidate_results()
+    print(f"[INFO] 商品相似度已重建，使用者數:{len(state['users'])}，商品數:{state['n_items']}，"
+          f"非零項:{state['C'].nnz}")
+    return {"users": len(state["users"]), "products": state["n_items"], "nnz": int(state["C"].nnz)}
+
+def _reco_apply(kind, uid, pid):
+    """套用一筆收藏事件，並重算該商品及與它有共同收藏的商品。重複事件不會重複計數。"""
+    with reco_lock:
+        state = reco_state
+        if state is None:
+            return
+        p = _reco_item_row(state, pid)
+        items = _reco_user_rows(state, uid)
+        if (kind == "add") == (p in items):
+            return
+        step = 1 if kind == "add" else -1
+        state["toggled"][uid] ^= {p}
+        others = items - {p}
+        for j in others:
+            state["overlay"][p][j] += step
+            state["overlay"][j][p] += step
+        state["overlay"][p][p] += step
+
+        # 該商品的收藏人數變了，所有與它有共同收藏的商品分數都要重算；移除時原本的共同收藏商品也要
+        affected = {p} | set(_reco_cooc_row(state, p)[0].tolist()) | others
+        for j in affected:
+            _reco_refresh_row(state, j)
+
+def _recommender_worker():
+    try:
+        rebuild_recommender()
     except Exception as e:
-        print(f"計算相似度矩陣時發生錯誤: {e}")
-        return None, None
+        print(f"[ERROR] 推薦系統初始化失敗: {e}")
+    while True:
+        try:
+            kind, uid, pid = reco_events.get(timeout=RECO_REBUILD_INTERVAL)
+        except queue.Empty:
+            kind = "rebuild"
+        try:
+            if kind == "rebuild":
+                rebuild_recommender()
+            else:
+                _reco_apply(kind, uid, pid)
+                invalidate_results(uid)   # 相似度更新完，之前快取的結果可能還是用舊相似度算的
+        except Exception as e:
+            print(f"[ERROR] 推薦系統更新失敗: {e}")
 
-# 為了效能，可以在應用程式啟動時預先計算好矩陣
-similarity_matrix, product_ids = None, None
-recommender_initialized = False
+def start_recommender():
+    threading.Thread(target=_recommender_worker, daemon=True).start()
 
-#第一次請求才計算，避免 server 啟動過慢
-@app.before_request
-def initialize_recommender():
-    """
-    在第一個請求進來時，初始化推薦系統的資料。
-    """
-    global similarity_matrix, product_ids, recommender_initialized
-    if not recommender_initialized:
-        similarity_matrix, product_ids = get_item_similarity_matrix()
-        recommender_initialized = True
-        print("已成功計算商品相似度矩陣")
+def recommender_favorite_changed(kind, uid, pid):
+    """收藏新增 ("add") / 移除 ("remove") 後呼叫；只丟事件，不等相似度重算。"""
+    invalidate_results(uid)
+    reco_events.put((kind, uid, pid))
+
+@job_handler("recommender_init")
+def _recommender_rebuild_job(payload=None):
+    # 重建也交給同一個 worker 依序處理：避免重建途中進來的收藏事件套到舊狀態後被換掉
+    reco_events.put(("rebuild", None, None))
+    return {"queued": True}
 
 # 取得相似商品
 #推薦系統相關函數
@@ -471,21 +1463,350 @@ def get_similar_products(product_id, n=5):
     """
     根據商品ID返回最相似的n個商品ID。
     """
-    global similarity_matrix
-    if similarity_matrix is None or product_id not in similarity_matrix.index:
+    state = reco_state
+    r = state["items"].get(product_id) if state else None
+    if r is None:
         return []
+    ids, scores = state["nbr_ids"][r, :n], state["nbr_scores"][r, :n]
+    return [{"product_id": int(j), "score": float(sc)} for j, sc in zip(ids.tolist(), scores.tolist()) if j >= 0]
 
-    # 找出與該商品最相似的商品
-    similar_products = similarity_matrix.loc[product_id].sort_values(ascending=False)
-    # 過濾掉自己，並取前 n 個
-    similar_products = similar_products[similar_products.index != product_id]
-    
-    result = [
-        {"product_id": int(idx), "score": float(score)} 
-        for idx, score in similar_products.head(n).items()
-    ]
+def _seed_neighbors(seed_pids, n_per_seed):
+    """
+    把多個收藏商品的 top-k 相似列攤平成 (候選商品 id, 分數, 來源收藏商品 id) 三個陣列，
+    已去掉補位的 -1 與收藏商品本身。
+    """
+    empty = np.empty(0, dtype=np.int64)
+    state = reco_state
+    if state is None or not seed_pids:
+        return empty, np.empty(0), empty
+    seeds = np.array([p for p in seed_pids if p in state["items"]], dtype=np.int64)
+    if seeds.size == 0:
+        return empty, np.empty(0), empty
+    rows = np.array([state["items"][p] for p in seeds.tolist()], dtype=np.int64)
+    ids = state["nbr_ids"][rows, :n_per_seed]
+    scores = state["nbr_scores"][rows, :n_per_seed].astype(np.float64)
+    sources = np.repeat(seeds, ids.shape[1]).reshape(ids.shape)
+
+    valid = (ids >= 0) & ~np.isin(ids, np.asarray(seed_pids, dtype=np.int64))
+    return ids[valid], scores[valid], sources[valid]
+
+def recommend_for_items(seed_pids, n_per_seed=5, limit=12):
+    """
+    一次對整組收藏商品做推薦：取出所有收藏商品的 top-k 相似列 (收藏數 × n_per_seed)，
+    排除已收藏的商品後以 bincount / maximum.at 彙總每個候選商品的分數（max 與 sum），
+    依 max 分數（同分再看 sum、商品 id）取前 limit 個。
+    回傳 [(商品 id, max 分數, [(來源收藏商品 id, 分數)])]。
+    """
+    ids, scores, sources = _seed_neighbors(seed_pids, n_per_seed)
+    if ids.size == 0:
+        return []
+    candidates, inverse = np.unique(ids, return_inverse=True)
+    best = np.zeros(candidates.size)
+    np.maximum.at(best, inverse, scores)
+    total = np.bincount(inverse, weights=scores, minlength=candidates.size)
+    top = np.lexsort((candidates, -total, -best))[:limit]
+
+    result = []
+    for c in top.tolist():
+        hit = inverse == c
+        result.append((int(candidates[c]), float(best[c]),
+                       list(zip(sources[hit].tolist(), scores[hit].tolist()))))
+    return result
+
+#混合推薦（偏好分類權重 + 收藏相似度），商品特徵快取在記憶體
+HYBRID_FEATURE_TTL = 60           # 商品特徵（門市庫存、特價、評分）最多落後資料庫幾秒
+HYBRID_SIMILARITY_WEIGHT = 1.0    # 與收藏商品的相似度（相似分數加總）併入偏好分數時的權重
+BRAND_GROUPS = (                  # 門市品牌正規化後的比對關鍵字
+    ("7-11", ("7eleven", "711")),
+    ("familymart", ("familymart",)),
+    ("hilife", ("hilife",)),
+    ("okmart", ("okmart",)),
+)
+hybrid_lock = threading.Lock()
+item_features = None              # 見 _load_item_features
+
+ITEM_FEATURES_SQL = hot_query("item_features", """
+    SELECT
+        p.id AS product_id, p.name, p.image_url, p.price, p.category, p.store_id,
+        s.name AS store_name, s.address, s.latitude, s.longitude, s.brand,
+        LOWER(REPLACE(REPLACE(IFNULL(s.brand,''),' ',''),'-','')) AS norm_brand,
+        COALESCE(ss.total_qty,0) AS store_remaining,
+        COALESCE(rs.avg_rating, 0) AS avg_rating,
+        COALESCE(rs.rating_count, 0) AS rating_count,
+        IFNULL(sp.discount_rate, 1.0) AS discount_rate,
+        CASE WHEN sp.discount_rate IS NULL THEN p.price ELSE ROUND(p.price * sp.discount_rate, 2) END AS final_price
+    FROM products p
+    JOIN stores s ON s.id = p.store_id
+    LEFT JOIN store_stock_summary ss ON ss.store_id = s.id
+    LEFT JOIN product_rating_stats rs ON rs.product_id = p.id
+    LEFT JOIN specials sp ON sp.product_id = p.id AND sp.store_id = p.store_id AND sp.end_date >= date('now')
+    ORDER BY p.id
+""", [], allow_scan=("products",))
+
+def _brand_group(norm_brand):
+    for key, patterns in BRAND_GROUPS:
+        if any(pat in norm_brand for pat in patterns):
+            return key
+    return ""
+
+def _load_item_features():
+    """一次讀出所有商品的推薦特徵，分類 / 品牌轉成代碼，數值欄位轉成 numpy 陣列。"""
+    rows = [dict(r) for r in query_db(ITEM_FEATURES_SQL)]
+    categories = {}
+    for r in rows:
+        categories.setdefault(r["category"], len(categories))
+    return {
+        "rows": rows,
+        "pids": np.array([r["product_id"] for r in rows], dtype=np.int64),
+        "store_ids": np.array([r["store_id"] for r in rows], dtype=np.int64),
+        "categories": categories,
+        "category": np.array([categories[r["category"]] for r in rows], dtype=np.int64),
+        "brand_group": np.array([_brand_group(r["norm_brand"]) for r in rows], dtype=object),
+        "store_remaining": np.array([r["store_remaining"] for r in rows], dtype=np.float64),
+        "discount_rate": np.array([r["discount_rate"] for r in rows], dtype=np.float64),
+        "final_price": np.array([r["final_price"] or 0 for r in rows], dtype=np.float64),
+        "built_at": time.time(),
+    }
+
+def hybrid_features():
+    """取得商品特徵快取；超過 HYBRID_FEATURE_TTL 或被清掉時重讀（同時只會有一個請求在重讀）。"""
+    global item_features
+    feats = item_features
+    if feats is not None and time.time() - feats["built_at"] < HYBRID_FEATURE_TTL:
+        return feats
+    with hybrid_lock:
+        feats = item_features
+        if feats is None or time.time() - feats["built_at"] >= HYBRID_FEATURE_TTL:
+            feats = item_features = _load_item_features()
+    return feats
+
+def invalidate_item_features():
+    """商品 / 特價 / 評分有變動時呼叫，下一次推薦會重讀特徵；已快取的推薦結果一併失效。"""
+    global item_features
+    item_features = None
+    invalidate_results()
+
+def user_category_weights(uid, feats):
+    """
+    使用者的分類權重向量（長度 = 分類數）：偏好設定的 weight + 各分類的收藏數。
+    另外回傳使用者收藏的商品 id，供相似度計算使用。訪客為全 0。
+    """
+    weights = np.zeros(len(feats["categories"]))
+    if uid is None:
+        return weights, []
+    for r in query_db("SELECT category, weight FROM user_preferences WHERE user_id = ?", [uid]):
+        code = feats["categories"].get(r["category"])
+        if code is not None:
+            weights[code] += r["weight"] or 0
+    fav_pids = [r["product_id"] for r in query_db("SELECT product_id FROM favorites WHERE user_id = ?", [uid])]
+    if fav_pids:
+        pos = np.searchsorted(feats["pids"], fav_pids)
+        pos = pos[pos < feats["pids"].size]
+        pos = pos[np.isin(feats["pids"][pos], fav_pids)]
+        weights += np.bincount(feats["category"][pos], minlength=weights.size)
+    return weights, fav_pids
+
+def _similarity_to_favorites(fav_pids, pids):
+    """每個商品與使用者收藏商品的相似分數加總（來自商品相似度的 top-k 陣列）。"""
+    sim = np.zeros(pids.size)
+    ids, scores, _ = _seed_neighbors(fav_pids, RECO_NEIGHBORS)
+    if ids.size == 0:
+        return sim
+    candidates, inverse = np.unique(ids, return_inverse=True)
+    total = np.bincount(inverse, weights=scores, minlength=candidates.size)
+    pos = np.minimum(np.searchsorted(candidates, pids), candidates.size - 1)
+    hit = candidates[pos] == pids
+    sim[hit] = total[pos[hit]]
+    return sim
+
+def hybrid_recommend(uid, brand="", limit=12, near=None):
+    """
+    混合推薦：分數 = 分類權重 + HYBRID_SIMILARITY_WEIGHT × 與收藏商品的相似度，
+    依 分數↓、門市剩餘量↓、折扣↑、(距離↑)、折後價↑ 排序後取前 limit 筆。
+    brand 為 BRAND_GROUPS 的 key（空字串不過濾）；near 為 grid_stores_within 的結果，
+    有傳入時只取這些門市的商品並附上 distance_km。
+    """
+    feats = hybrid_features()
+    n = feats["pids"].size
+    mask = np.ones(n, dtype=bool)
+    if brand:
+        mask &= feats["brand_group"] == brand
+
+    distance = None
+    if near is not None:
+        near_ids = np.array([s["id"] for s, _ in near], dtype=np.int64)
+        near_dist = np.array([d for _, d in near], dtype=np.float64)
+        distance = np.full(n, np.inf)
+        if near_ids.size:
+            pos = np.minimum(np.searchsorted(near_ids, feats["store_ids"]), near_ids.size - 1)
+            hit = near_ids[pos] == feats["store_ids"]
+            distance[hit] = near_dist[pos[hit]]
+        mask &= np.isfinite(distance)
+
+    weights, fav_pids = user_category_weights(uid, feats)
+    pref = weights[feats["category"]]
+    similarity = _similarity_to_favorites(fav_pids, feats["pids"])
+    score = pref + HYBRID_SIMILARITY_WEIGHT * similarity
+
+    idx = np.flatnonzero(mask)
+    keys = [feats["final_price"][idx]]
+    if distance is not None:
+        keys.append(distance[idx])
+    keys += [feats["discount_rate"][idx], -feats["store_remaining"][idx], -score[idx]]
+    top = idx[np.lexsort(keys)[:limit]]
+
+    result = []
+    for i in top.tolist():
+        row = dict(feats["rows"][i], pref_score=float(pref[i]), similarity=round(float(similarity[i]), 4),
+                   score=round(float(score[i]), 4))
+        if distance is not None:
+            row["distance_km"] = float(distance[i])
+        else:
+            del row["norm_brand"]
+        result.append(row)
     return result
 
+#推薦結果快取：key = (端點, 使用者, 品牌, 位置格子, 其他參數)
+# 每筆記下算出當時的「全域版本」與「該使用者版本」，事件只負責把版本 +1，舊結果在下次讀取時視為過期，
+# 不必逐筆找出來刪；記憶體由 LRU 上限控制。
+#   使用者版本：save_user_prefs、收藏新增 / 移除（含相似度背景更新完成後）
+#   全域版本：update_stock() 每次 tick、特價到期（UTC 換日，與 SQL 的 date('now') 一致）、商品特徵失效
+RESULT_CACHE_SIZE = 2048
+RESULT_CELL_DEG = 0.001    # 位置量化的格子邊長 (度)，約 110 公尺；同一格內共用結果
+result_cache = OrderedDict()   # key -> (全域版本, 使用者版本, 值)
+result_cache_lock = threading.Lock()
+result_generation = 0
+result_user_generation = defaultdict(int)
+result_cache_day = None
+result_inflight = {}       # key -> threading.Event：正在計算的 key，同一個 key 的其他請求等它算完
+RESULT_WAIT_TIMEOUT = 10   # 秒；等太久就自己算
+
+def result_cell(lat, lng):
+    return (math.floor(lat / RESULT_CELL_DEG), math.floor(lng / RESULT_CELL_DEG))
+
+def invalidate_results(uid=None):
+    """uid=None 讓所有人的推薦結果失效（含跨 process 的訪客快取），否則只有該使用者的。"""
+    global result_generation
+    with result_cache_lock:
+        if uid is None:
+            result_generation += 1
+        else:
+            result_user_generation[uid] += 1
+    if uid is None and SHARED_CACHE_DB:
+        _shared_cache_expire()
+
+def _check_special_expiry():
+    """換日後特價可能到期：清掉商品特徵（連帶所有推薦結果）。"""
+    global result_cache_day
+    today = time.strftime("%Y-%m-%d", time.gmtime())
+    if today != result_cache_day:
+        result_cache_day = today
+        invalidate_item_features()
+
+def cached_result(key, uid, compute):
+    """有未過期的結果就直接回傳，否則呼叫 compute() 算出並放進快取。"""
+    _check_special_expiry()
+    owner = False
+    while not owner:
+        with result_cache_lock:
+            versions = (result_generation, result_user_generation.get(uid, 0))
+            hit = result_cache.get(key)
+            if hit is not None and hit[:2] == versions:
+                result_cache.move_to_end(key)
+                return hit[2]
+            pending = result_inflight.get(key)
+            if pending is None:
+                pending = result_inflight[key] = threading.Event()
+                owner = True
+        # 同一個 key 已經有人在算（例如快取剛失效時湧入的訪客），等它算完再讀
+        if not owner and not pending.wait(RESULT_WAIT_TIMEOUT):
+            break
+
+    try:
+        value = _shared_cache_fetch(key, compute) if uid is None and SHARED_CACHE_DB else compute()
+        # 計算期間若有事件把版本往上加，存進去的是舊版本，下次讀取就會重算
+        with result_cache_lock:
+            result_cache[key] = (*versions, value)
+            result_cache.move_to_end(key)
+            while len(result_cache) > RESULT_CACHE_SIZE:
+                result_cache.popitem(last=False)
+        return value
+    finally:
+        if owner:
+            with result_cache_lock:
+                result_inflight.pop(key, None)
+            pending.set()
+
+#訪客共用快取（可選擇跨 process）
+# 訪客沒有個人化資料，結果只跟 (品牌, 位置, 半徑, 筆數) 有關：位置先對齊到 GUEST_CELL_DEG 格子中心再算，
+# 同一格的訪客共用同一份結果。設定環境變數 RESPONSE_CACHE_DB（SQLite 檔案路徑）時，
+# 多個 worker process 之間也共用：過期的 key 由搶到租約的 process 重算，其他 process 先回舊值或等它寫回。
+GUEST_CELL_DEG = 0.002            # 約 220 公尺
+SHARED_CACHE_DB = os.environ.get("RESPONSE_CACHE_DB", "")
+SHARED_CACHE_TTL = 30             # 秒；其他 process 的失效事件只會讓資料提早過期，TTL 是上限
+SHARED_CACHE_LEASE = 10           # 秒；重算租約，持有者當掉時最多這麼久後換人重算
+shared_cache_local = threading.local()
+
+def guest_cell_center(lat, lng):
+    """把訪客位置對齊到 GUEST_CELL_DEG 格子中心。"""
+    return ((math.floor(lat / GUEST_CELL_DEG) + 0.5) * GUEST_CELL_DEG,
+            (math.floor(lng / GUEST_CELL_DEG) + 0.5) * GUEST_CELL_DEG)
+
+def _shared_cache_conn():
+    """每個執行緒一條連到 RESPONSE_CACHE_DB 的連線（autocommit）。"""
+    conn = getattr(shared_cache_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(SHARED_CACHE_DB, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = OFF")   # 只是快取，檔案壞了刪掉重建即可
+        conn.execute("""CREATE TABLE IF NOT EXISTS response_cache(
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            expires_at REAL NOT NULL DEFAULT 0,
+            lease_until REAL NOT NULL DEFAULT 0
+        )""")
+        shared_cache_local.conn = conn
+    return conn
+
+def _shared_cache_expire():
+    """讓所有共用快取過期，但保留舊值，重算期間其他 process 仍有東西可回。"""
+    try:
+        _shared_cache_conn().execute("UPDATE response_cache SET expires_at = 0")
+    except sqlite3.Error as e:
+        print(f"[ERROR] 共用快取失效失敗: {e}")
+
+def _shared_cache_fetch(key, compute):
+    """跨 process 快取：新鮮就直接用；過期時搶租約，搶到的重算，沒搶到的回舊值（沒有舊值就等）。"""
+    conn = _shared_cache_conn()
+    k = json.dumps(key, ensure_ascii=False)
+    deadline = time.time() + SHARED_CACHE_LEASE
+    while True:
+        now = time.time()
+        row = conn.execute("SELECT value, expires_at FROM response_cache WHERE key = ?", (k,)).fetchone()
+        if row and row[0] is not None and row[1] > now:
+            return json.loads(row[0])
+        cur = conn.execute("""
+            INSERT INTO response_cache (key, lease_until) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET lease_until = excluded.lease_until
+            WHERE response_cache.lease_until < ?
+        """, (k, now + SHARED_CACHE_LEASE, now))
+        if cur.rowcount == 1:
+            break
+        if row and row[0] is not None:
+            return json.loads(row[0])
+        if now >= deadline:
+            return compute()   # 租約持有者遲遲沒寫回，不再等
+        time.sleep(0.05)
+
+    try:
+        value = compute()
+    except Exception:
+        conn.execute("UPDATE response_cache SET lease_until = 0 WHERE key = ?", (k,))
+        raise
+    conn.execute("UPDATE response_cache SET value = ?, expires_at = ?, lease_until = 0 WHERE key = ?",
+                 (json.dumps(value, ensure_ascii=False), time.time() + SHARED_CACHE_TTL, k))
+    return value
+
 #使用者偏好系統（Category-based）
 #API，使用者第一次登入會跳 Modal，存偏好類別（如：飲料、零食），可與推薦系統混合（Hybrid Recommender）
 @app.post("/api/user/reco_prefs")
@@ -509,17 +1830,11 @@ def api_user_reco_prefs():
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
-@app.route("/api/import_stores", methods=["POST"])
-def api_import_stores():
-    # For security, in production protect this endpoint (auth/roles). Kept open here for demo/dev.
-    file = request.files.get("file")
-    brand = request.form.get("brand") or ""
-    if not file:
-        return jsonify({"ok": False, "error": "缺少檔案"}), 400
+def import_stores_csv(text, brand=""):
+    """匯入門市 CSV，回傳新增筆數。"""
     # Expected CSV headers: name,address,latitude,longitude[,brand]
     import io, csv
-    f = io.StringIO(file.stream.read().decode("utf-8"))
-    reader = csv.DictReader(f)
+    reader = csv.DictReader(io.StringIO(text))
     count = 0
     for row in reader:
         try:
@@ -534,19 +1849,32 @@ def api_import_stores():
             ex = query_db("SELECT id FROM stores WHERE name=? AND printf('%.6f',latitude)=printf('%.6f',?) AND printf('%.6f',longitude)=printf('%.6f',?) AND IFNULL(brand,'')=IFNULL(?, '')",
                           [name, lat, lng, b], one=True)
             if not ex:
-                exec_db("INSERT INTO stores (name,address,latitude,longitude,brand) VALUES (?,?,?,?,?)", [name,address,lat,lng,b])
+                sid = exec_db("INSERT INTO stores (name,address,latitude,longitude,brand) VALUES (?,?,?,?,?)", [name,address,lat,lng,b])
+                # 同步更新門市空間索引
+                grid_add_store({"id": sid, "name": name, "address": address,
+                                "latitude": lat, "longitude": lng, "brand": b})
                 count += 1
         except Exception as e:
             continue
-    return jsonify({"ok": True, "inserted": count})
+    return count
+
+@job_handler("import_stores")
+def _import_stores_job(payload):
+    return {"inserted": import_stores_csv(payload.get("csv") or "", payload.get("brand") or "")}
+
+@app.route("/api/import_stores", methods=["POST"])
+def api_import_stores():
+    # For security, in production protect this endpoint (auth/roles). Kept open here for demo/dev.
+    file = request.files.get("file")
+    brand = request.form.get("brand") or ""
+    if not file:
+        return jsonify({"ok": False, "error": "缺少檔案"}), 400
+    text = file.stream.read().decode("utf-8")
+    # async=1：交給背景工作，立即回傳 job id
+    if request.form.get("async") == "1":
+        return request_job("import_stores", {"csv": text, "brand": brand})
+    return jsonify({"ok": True, "inserted": import_stores_csv(text, brand)})
 
-def check_and_add_column(conn):
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA table_info(accounts);")
-    columns = [column[1] for column in cursor.fetchall()]
-    if 'avatar_url' not in columns:
-        cursor.execute("ALTER TABLE accounts ADD COLUMN avatar_url TEXT;")
-        conn.commit()
 """
 def get_db():
     conn = sqlite3.connect(DB_PATH)
@@ -556,22 +1884,64 @@ def get_db():
     user_data = cursor.execute("SELECT username, email, avatar_url FROM accounts WHERE id = ?", (user_id,)).fetchone()
     return conn
 """
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+#資料庫連線池
+# 每次查詢都重開連線、跑 PRAGMA 的成本遠高於查詢本身，
+# 改成請求開始時向連線池借一條長連線，整個請求共用，請求結束（teardown）再歸還。
+DB_POOL_SIZE = 8   # 連線池保留的閒置連線數，超過的歸還時直接關閉
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)   # LIFO：優先重用剛用過、快取還熱的連線
+
+def _new_db_connection():
+    """建立新連線，連線層級的 PRAGMA 只在這裡設定一次。"""
+    # 連線會在不同請求執行緒之間輪流使用（同一時間只屬於一個請求）
+    conn = sqlite3.connect(DB_PATH, timeout=5, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")      # WAL 下 NORMAL 已足夠安全，寫入少一次 fsync
+    conn.execute("PRAGMA cache_size = -16000")       # 約 16MB page cache
+    conn.execute("PRAGMA mmap_size = 134217728")     # 128MB memory-mapped I/O
+    return conn
 
-    # 確保有 avatar_url 欄位
-    check_and_add_column(conn)
+def _pool_acquire():
+    try:
+        return _db_pool.get_nowait()
+    except queue.Empty:
+        return _new_db_connection()
 
-    cursor = conn.cursor()
-    user_id = session.get("id")
-    user_data = None
-    if user_id is not None:
-        user_data = cursor.execute(
-            "SELECT username, email, avatar_url FROM accounts WHERE id = ?", 
-            (user_id,)
-        ).fetchone()
-    return conn
+def _pool_release(conn):
+    try:
+        # 沒 commit 的寫入不能帶給下一個使用者
+        if conn.in_transaction:
+            conn.rollback()
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+    except sqlite3.Error:
+        try: conn.close()
+        except: pass
+
+def get_db():
+    """取得本次請求的連線（同一請求內共用，請求結束自動歸還連線池，呼叫端不要 close）。"""
+    if "db" not in g:
+        g.db = _pool_acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        _pool_release(conn)
+
+@contextmanager
+def db_connection():
+    """請求內用 get_db() 的連線；背景執行緒等沒有 app context 的地方則暫借一條，用完歸還。"""
+    if has_app_context():
+        yield get_db()
+        return
+    conn = _pool_acquire()
+    try:
+        yield conn
+    finally:
+        _pool_release(conn)
 
 def get_center():
     lat = session.get("center_lat")
@@ -590,30 +1960,171 @@ def get_radius_km():
     return r
 
 def query_db(query, args=(), one=False):
-    con = get_db()
-    cur = con.execute(query, args)
-    rv = cur.fetchall()
-    cur.close()
-    con.close()
+    with db_connection() as con:
+        cur = con.execute(query, args)
+        rv = cur.fetchall()
+        cur.close()
     return (rv[0] if rv else None) if one else rv
 
 # 這是您之前優化後的 exec_db 結構，請確認 timeout=5 的設定
-def exec_db(query, args=()):
+def exec_db(query, args=(), user_id=None):
+    """執行一筆寫入並 commit；同時把寫入資料表的資料版本 +1（有 user_id 時只動該使用者的版本）。"""
     try:
-        # 使用 timeout=5 來確保連線不會無限期等待
-        with sqlite3.connect(DB_PATH, timeout=5) as con: 
+        # 連線池的連線已設定 timeout=5，確保不會無限期等待
+        with db_connection() as con:
             cur = con.cursor()
-            cur.execute(query, args)
-            con.commit()
+            try:
+                cur.execute(query, args)
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
             last_id = cur.lastrowid
-            return last_id
-            
+        m = _WRITE_TABLE_RE.match(query)
+        if m:
+            bump_data_version(m.group(1).lower(), user_id)
+        return last_id
+
     except sqlite3.OperationalError as e:
         if "database is locked" in str(e):
             # 這是您的日誌訊息，現在它會提示您 WAL 模式是最終解法
             print("SQLite 鎖定錯誤發生，請檢查其他長時間運行的寫入操作或啟用 WAL 模式。")
         raise e
 
+#資料版本與條件式 GET（ETag）
+# 每個資料表一個版本，「資料表 + 使用者」另有一個版本；寫入時 +1，ETag 由回應依賴的版本組成。
+# 用戶端帶 If-None-Match 且版本都沒變時，在執行 view（以及任何 SQL）之前就回 304。
+# 版本只存在這個 process 的記憶體：EPOCH 讓重啟前的 ETag 全部失效；其他 process 對商品 / 門市的寫入
+# 由 update_stock() 的 products_version 與格子索引的 store_grid_version 偵測後 +1。
+DATA_VERSION_EPOCH = uuid.uuid4().hex[:8]
+data_versions = defaultdict(int)   # 資料表 或 (資料表, user_id) -> 版本
+data_versions_lock = threading.Lock()
+_WRITE_TABLE_RE = re.compile(
+    r"\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+(\w+)", re.I)
+
+def bump_data_version(table, user_id=None):
+    """table 有寫入；user_id 不為 None 表示只影響該使用者的資料。"""
+    with data_versions_lock:
+        data_versions[table if user_id is None else (table, user_id)] += 1
+
+def data_etag(tables, per_user=(), user_id=None, daily=False):
+    with data_versions_lock:
+        parts = [DATA_VERSION_EPOCH]
+        parts += [data_versions.get(t, 0) for t in tables]
+        parts += [f"{data_versions.get(t, 0)}.{data_versions.get((t, user_id), 0)}" for t in per_user]
+    if per_user:
+        parts.append(f"u{user_id}")   # 版本號各使用者可能相同（例如重啟後都是 0），ETag 必須帶使用者
+    if daily:
+        parts.append(time.strftime("%Y%m%d", time.gmtime()))   # date('now') 換日，特價可能到期
+    return "-".join(str(p) for p in parts)
+
+def versioned(*tables, per_user=(), daily=False):
+    """
+    依資料版本加上 strong ETag 的裝飾器。tables：回應依賴的資料表；
+    per_user：依賴該使用者資料的資料表（表版本與使用者版本都算）；daily：回應用到 date('now')。
+    """
+    def deco(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # 在執行 view 前取版本：執行期間若有寫入，下次比對不會相符，只會多回一次完整內容
+            etag = data_etag(tables, per_user, session.get("user_id"), daily)
+            if request.if_none_match.contains(etag):
+                resp = Response(status=304)
+            else:
+                resp = app.make_response(view(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+            resp.set_etag(etag)
+            resp.headers["Cache-Control"] = "private, no-cache" if per_user else "no-cache"
+            if per_user:
+                resp.vary.add("Cookie")   # 同一個瀏覽器換帳號登入時，不能拿前一個使用者的快取來比對
+            return resp
+        return wrapper
+    return deco
+
+#背景工作執行與查詢
+def _run_job(job_id, kind, payload):
+    with app.app_context():
+        exec_db("UPDATE jobs SET status='running', started_at=datetime('now','localtime') WHERE id=?", [job_id])
+        try:
+            result = JOB_HANDLERS[kind](payload)
+            exec_db("UPDATE jobs SET status='done', result=?, finished_at=datetime('now','localtime') WHERE id=?",
+                    [json.dumps(result, ensure_ascii=False), job_id])
+        except Exception as e:
+            print(f"[ERROR] 背景工作 {kind} ({job_id}) 失敗: {e}")
+            exec_db("UPDATE jobs SET status='error', error=?, finished_at=datetime('now','localtime') WHERE id=?",
+                    [str(e), job_id])
+
+def submit_job(kind, payload=None, user_id=None):
+    """送出背景工作，回傳 job id。"""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"未知的工作類型: {kind}")
+    job_id = uuid.uuid4().hex
+    exec_db("DELETE FROM jobs WHERE finished_at IS NOT NULL AND created_at < datetime('now','localtime', ?)",
+            [f"-{JOB_RETENTION_HOURS} hours"])
+    exec_db("INSERT INTO jobs (id, kind, user_id) VALUES (?,?,?)", [job_id, kind, user_id])
+    job_executor.submit(_run_job, job_id, kind, payload or {})
+    return job_id
+
+def get_job(job_id, user_id=None):
+    """讀取工作狀態；屬於其他使用者的工作視為不存在。"""
+    row = query_db("SELECT * FROM jobs WHERE id=?", [job_id], one=True)
+    if not row or (row["user_id"] is not None and row["user_id"] != user_id):
+        return None
+    job = {k: row[k] for k in ("id", "kind", "status", "created_at", "started_at", "finished_at", "error")}
+    job["result"] = json.loads(row["result"]) if row["result"] else None
+    return job
+
+def job_accepted(job_id):
+    return jsonify({"ok": True, "job_id": job_id, "status_url": url_for("api_job", job_id=job_id),
+                    "stream_url": url_for("api_job_stream", job_id=job_id)}), 202
+
+def request_job(kind, payload):
+    """由 HTTP 請求送出背景工作：一律要登入（工作會佔用執行緒池），回傳 202 或 401。"""
+    user_id = session.get("user_id")
+    if not user_id:
+        return jsonify({"ok": False, "error": "not_logged_in"}), 401
+    return job_accepted(submit_job(kind, payload, user_id))
+
+@app.route("/api/jobs", methods=["POST"])
+def api_jobs_submit():
+    data = request.get_json(silent=True) or {}
+    kind = data.get("kind")
+    # recommender_init / import_stores 等內部工作不開放直接送出
+    if kind not in JOB_PUBLIC_KINDS:
+        return jsonify({"ok": False, "error": f"kind 必須是 {', '.join(sorted(JOB_PUBLIC_KINDS))} 之一"}), 400
+    return request_job(kind, data.get("payload") or {})
+
+@app.route("/api/jobs/<job_id>")
+def api_job(job_id):
+    job = get_job(job_id, session.get("user_id"))
+    if not job:
+        return jsonify({"ok": False, "error": "找不到工作"}), 404
+    return jsonify({"ok": True, "job": job})
+
+@app.route("/api/jobs/<job_id>/stream")
+def api_job_stream(job_id):
+    """Server-Sent Events：狀態有變就送一次，完成或失敗後結束。"""
+    user_id = session.get("user_id")
+    if not get_job(job_id, user_id):
+        return jsonify({"ok": False, "error": "找不到工作"}), 404
+
+    def events():
+        last = None
+        while True:
+            with app.app_context():
+                job = get_job(job_id, user_id)
+            if job is None:
+                return
+            if job["status"] != last:
+                last = job["status"]
+                yield f"event: {last}\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+            if last in ("done", "error"):
+                return
+            time.sleep(JOB_STREAM_INTERVAL)
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.route("/")
 def index():
     lat, lng = get_center()
@@ -679,14 +2190,12 @@ def register():
                 con = sqlite3.connect(_db_path())
                 cur = con.cursor()
                 # 盡量包含建立時間；若沒有該欄位也會照常寫入
-                columns = f"(username, email, {pw_col}, created_at)"
-                placeholders = "(?, ?, ?, CURRENT_TIMESTAMP)"
-                try:
+                if "created_at" in SCHEMA_COLUMNS.get("accounts", set()):
                     cur.execute(
-                        f"INSERT INTO accounts {columns} VALUES {placeholders}",
+                        f"INSERT INTO accounts (username, email, {pw_col}, created_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
                         (username, email, pw_val),
                     )
-                except sqlite3.OperationalError:
+                else:
                     # 沒有 created_at 欄位時退回三欄
                     cur.execute(
                         f"INSERT INTO accounts (username, email, {pw_col}) VALUES (?, ?, ?)",
@@ -715,31 +2224,79 @@ def logout():
     flash("已登出", "ok")
     return redirect(url_for("index"))
 
+# DISTINCT 必須掃過整個 category 索引（只讀索引、不回表），結果另有 cached_result 快取
+CATEGORIES_SQL = hot_query(
+    "categories",
+    "SELECT DISTINCT COALESCE(category,'') AS category FROM products ORDER BY category",
+    allow_scan=("products",)
+)
+
 @app.route("/api/categories")
+@versioned("products")
 def api_categories():
-    rows = query_db("SELECT DISTINCT COALESCE(category,'') AS category FROM products ORDER BY category")
-    # 回傳非空類別
-    cats = [r["category"] for r in rows if r["category"]]
-    return jsonify(cats)
-
-#商品搜尋（SQL 重點）
-@app.route("/api/products/search")
-def api_product_search():
-    q         = (request.args.get("q") or "").strip()
-    category  = (request.args.get("category") or "").strip()
-    min_price = request.args.get("min_price", type=float)
-    max_price = request.args.get("max_price", type=float)
-    limit     = request.args.get("limit", default=100, type=int)
-    sort_by   = request.args.get('sort', '')
+    # 類別與使用者無關，所有人共用訪客快取；回傳非空類別
+    return jsonify(cached_result(("categories",), None, lambda: [
+        r["category"] for r in query_db(CATEGORIES_SQL) if r["category"]
+    ]))
+
+#串流回應（結果很多時逐批從 cursor 取出、逐批輸出，不先組成完整 list）
+# 用 ?stream=ndjson（每行一筆 JSON）或 ?stream=json（分段輸出的 JSON array）開啟，沒指定時照舊回傳一般 JSON。
+# 只看 query 參數、不看 Accept：不同格式就是不同 URL，ETag / 快取不會把某一種格式的內容給另一種。
+STREAM_BATCH_ROWS = 200   # 每批 fetchmany / 輸出的筆數
+
+def stream_mode():
+    mode = (request.args.get("stream") or "").lower()
+    if mode in ("ndjson", "json"):
+        return mode
+    if mode in ("1", "true"):
+        return "ndjson"
+    return None
 
-    user_lat = request.args.get('lat', type=float)
-    user_lng = request.args.get('lng', type=float)
+def iter_query_batches(query, args=(), size=STREAM_BATCH_ROWS):
+    """逐批 fetchmany 的產生器；回應開始輸出後 app context 已結束，會自己向連線池借一條連線。"""
+    with db_connection() as con:
+        cur = con.execute(query, args)
+        try:
+            while True:
+                rows = cur.fetchmany(size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cur.close()
+
+def stream_batches(batches, mode):
+    """把一批批的 dict 序列化成串流回應；每批輸出一個 chunk，第一批算好就送出。"""
+    def ndjson():
+        for batch in batches:
+            if batch:
+                yield "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch)
+
+    def json_array():
+        sep = "["
+        for batch in batches:
+            if batch:
+                yield sep + ",".join(json.dumps(r, ensure_ascii=False) for r in batch)
+                sep = ","
+        yield "[]" if sep == "[" else "]"
+
+    if mode == "ndjson":
+        return Response(ndjson(), mimetype="application/x-ndjson")
+    return Response(json_array(), mimetype="application/json")
 
+#商品搜尋（SQL 重點）
+def _product_search_sql(q="", category="", min_price=None, max_price=None, sort_by="",
+                        near_json=None, limit=None):
+    """
+    組出商品搜尋 SQL，回傳 (sql, params)。
+    near_json：半徑內門市距離表（stores_within_json），有給才聯結並可依距離排序；
+    limit=None：不排序也不限制筆數（交給呼叫端在 Python 端排序）。
+    """
     sql = """
     SELECT p.id, p.name, p.image_url, p.price, p.category,p.store_id AS store_id,
            s.name AS store_name, s.brand, s.address, s.latitude, s.longitude,
            p.remaining_qty,
-           COALESCE((SELECT AVG(rating) FROM product_reviews r WHERE r.product_id = p.id), 0) AS avg_rating,
+           COALESCE(rs.avg_rating, 0) AS avg_rating,
            IFNULL(sp.discount_rate, 1.0) AS discount_rate,
            CASE WHEN sp.discount_rate IS NULL 
                 THEN p.price 
@@ -749,26 +2306,27 @@ def api_product_search():
 
     params = []
 
-    # 如果有定位，才算距離
-    if user_lat is not None and user_lng is not None:
-        sql += """,
-        ROUND(
-            6371 * 2 * ASIN(
-                SQRT(
-                  POWER(SIN(RADIANS((s.latitude  - ?)/2.0)), 2) +
-                  COS(RADIANS(?)) * COS(RADIANS(s.latitude)) *
-                  POWER(SIN(RADIANS((s.longitude - ?)/2.0)), 2)
-            )
-        ), 2
-    ) AS distance_km
-        """
-        params.extend([user_lat, user_lat, user_lng])
+    # 距離一律由距離引擎計算：有半徑時先取得半徑內門市的距離表再聯結，
+    # 沒有半徑時由呼叫端對查出來的商品補算距離
+    if near_json is not None:
+        sql += ", ROUND(near.distance_km, 2) AS distance_km"
     else:
         sql += ", NULL AS distance_km"
 
     sql += """
     FROM products p
     JOIN stores s ON s.id = p.store_id
+    """
+
+    if near_json is not None:
+        sql += """
+    JOIN (SELECT CAST(key AS INTEGER) AS store_id, value AS distance_km
+          FROM json_each(?)) near ON near.store_id = s.id
+        """
+        params.append(near_json)
+
+    sql += """
+    LEFT JOIN product_rating_stats rs ON rs.product_id = p.id
     LEFT JOIN specials sp ON sp.product_id = p.id
                          AND sp.store_id = p.store_id
                          AND sp.end_date >= date('now')
@@ -796,16 +2354,74 @@ def api_product_search():
         sql += " ORDER BY avg_rating DESC"
     elif sort_by == 'remain_qty':
         sql += " ORDER BY p.remaining_qty DESC"
-    elif sort_by == 'distance' and user_lat is not None and user_lng is not None:
+    elif sort_by == 'distance' and near_json is not None:
         sql += " ORDER BY distance_km ASC"
-    else:
+    elif limit is not None:
         sql += " ORDER BY sp.discount_rate ASC, avg_rating DESC, p.remaining_qty DESC, final_price ASC"
 
-    sql += " LIMIT ?"
-    params.append(limit)
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
 
-    rows = query_db(sql, params)
-    return jsonify([dict(r) for r in rows])
+hot_query("product_search", *_product_search_sql(q="飯", category="便當", limit=100))
+hot_query("product_search_near", *_product_search_sql(sort_by="distance", near_json='{"1": 0.5}', limit=100))
+# 沒選分類只下關鍵字：LIKE '%關鍵字%' 用不到索引，本來就得掃 products
+hot_query("product_search_all", *_product_search_sql(q="飯", limit=100), allow_scan=("products",))
+
+@app.route("/api/products/search")
+def api_product_search():
+    q         = (request.args.get("q") or "").strip()
+    category  = (request.args.get("category") or "").strip()
+    min_price = request.args.get("min_price", type=float)
+    max_price = request.args.get("max_price", type=float)
+    limit     = request.args.get("limit", default=100, type=int)
+    sort_by   = request.args.get('sort', '')
+
+    user_lat = request.args.get('lat', type=float)
+    user_lng = request.args.get('lng', type=float)
+    radius   = request.args.get('radius', type=float)   # 選填：只找半徑內門市的商品
+    has_loc  = user_lat is not None and user_lng is not None
+    near_radius = has_loc and radius is not None
+    bad = bad_geo_args(user_lat, user_lng, radius)
+    if bad:
+        return bad
+
+    # 依距離排序但沒有半徑：距離要在 Python 端算完才能排序，SQL 不排序也不加 LIMIT
+    sort_in_python = sort_by == 'distance' and has_loc and not near_radius
+
+    sql, params = _product_search_sql(
+        q, category, min_price, max_price, sort_by,
+        near_json=stores_within_json(user_lat, user_lng, radius) if near_radius else None,
+        limit=None if sort_in_python else limit,
+    )
+
+    # 串流：距離排序需要全部結果才能排，其餘情況直接從 cursor 逐批輸出（每批各自補上距離）
+    mode = stream_mode()
+    if mode and not sort_in_python:
+        def batches():
+            for batch in iter_query_batches(sql, params):
+                batch = [dict(r) for r in batch]
+                if has_loc and not near_radius:
+                    dist = store_distances_km(user_lat, user_lng, [r["store_id"] for r in batch])
+                    for r, d in zip(batch, dist):
+                        r["distance_km"] = None if np.isnan(d) else round(float(d), 2)
+                yield batch
+        return stream_batches(batches(), mode)
+
+    rows = [dict(r) for r in query_db(sql, params)]
+
+    if has_loc and not near_radius and rows:
+        dist = store_distances_km(user_lat, user_lng, [r["store_id"] for r in rows])
+        for r, d in zip(rows, dist):
+            r["distance_km"] = None if np.isnan(d) else round(float(d), 2)
+        if sort_in_python:
+            order = np.argsort(dist, kind="stable")[:limit]
+            rows = [rows[i] for i in order]
+
+    if mode:
+        return stream_batches((rows[i:i + STREAM_BATCH_ROWS] for i in range(0, len(rows), STREAM_BATCH_ROWS)), mode)
+    return jsonify(rows)
 
 def login_required(view_func):
     @wraps(view_func)
@@ -881,6 +2497,7 @@ def profile():
                 cursor.execute("INSERT INTO user_preferences (user_id, category) VALUES (?, ?)", (user_id, cat))
             
             conn.commit()
+            invalidate_results(user_id)
             flash("推薦商品依據已更新！", "ok")
 
         return redirect(url_for("profile"))
@@ -934,9 +2551,9 @@ def profile():
                 cursor.execute("INSERT INTO user_preferences (user_id, category) VALUES (?, ?)", (user_id, cat))
             
             conn.commit()
+            invalidate_results(user_id)
             flash("推薦商品依據已更新！", "ok")
 
-        conn.close()
         return redirect(url_for("profile"))
 
     # GET 請求時，獲取使用者資料和偏好設定
@@ -954,7 +2571,6 @@ def profile():
     user_preferences = [pref[0] for pref in raw_preferences]
 
     all_categories = [row[0] for row in cursor.execute("SELECT DISTINCT category FROM products WHERE category IS NOT NULL").fetchall()]
-    conn.close()
     
     return render_template("profile.html", user=user, user_preferences=user_preferences, all_categories=all_categories)
 
@@ -1030,12 +2646,25 @@ def change_avatar():
         (f"avatars/{filename}", user_id)   # <── 這裡改成存相對路徑
     )
     conn.commit()
-    conn.close()
     
     flash("頭像已成功更新！", "ok")
     return redirect(url_for("profile"))
 
 
+STORE_PRODUCTS_SQL = hot_query("store_products", """
+    SELECT p.*, 
+           IFNULL(s.discount_rate, 1.0) AS discount_rate,
+           CASE WHEN s.discount_rate IS NULL THEN p.price ELSE ROUND(p.price * s.discount_rate,2) END AS final_price,
+           s.end_date AS discount_end,
+           COALESCE(rs.avg_rating, 0) AS avg_rating,
+           COALESCE(rs.rating_count, 0) AS rating_count
+    FROM products p
+    LEFT JOIN product_rating_stats rs ON rs.product_id = p.id
+    LEFT JOIN specials s ON s.product_id = p.id AND s.store_id = ? AND s.end_date >= date('now')
+    WHERE p.store_id = ?
+    ORDER BY final_price ASC
+""", [1, 1])
+
 @app.route("/store/<int:store_id>")
 @login_required
 def store_page(store_id):
@@ -1043,18 +2672,7 @@ def store_page(store_id):
     if not store:
         return "店家不存在", 404
     products = query_db(
-        """
-        SELECT p.*, 
-               IFNULL(s.discount_rate, 1.0) AS discount_rate,
-               CASE WHEN s.discount_rate IS NULL THEN p.price ELSE ROUND(p.price * s.discount_rate,2) END AS final_price,
-               s.end_date AS discount_end,
-               COALESCE((SELECT AVG(rating) FROM product_reviews r WHERE r.product_id = p.id), 0) AS avg_rating,
-               COALESCE((SELECT COUNT(*) FROM product_reviews r WHERE r.product_id = p.id), 0) AS rating_count
-        FROM products p
-        LEFT JOIN specials s ON s.product_id = p.id AND s.store_id = ? AND s.end_date >= date('now')
-        WHERE p.store_id = ?
-        ORDER BY final_price ASC
-        """,
+        STORE_PRODUCTS_SQL,
         [store_id, store_id]
     )
     return render_template("store.html", store=store, products=products)
@@ -1085,6 +2703,7 @@ def favorites_insights():
 
 @app.route("/api/fav_stats")
 @login_required
+@versioned("products", "stores", "product_reviews", per_user=("favorites",))
 def api_fav_stats():
     uid = session["user_id"]
 
@@ -1144,43 +2763,42 @@ def api_fav_stats():
 def favorites_page():
     return render_template("favorites.html")
 
+FAVORITES_SQL = hot_query("favorites", """
+    SELECT 
+        f.id as fav_id, f.created_at,
+        p.id as product_id, p.name, p.image_url, p.price, p.category, p.remaining_qty as remaining_qty,
+        s.name as store_name, s.brand, s.address,
+        rs.avg_rating,
+
+        -- ** 新增：折扣率和最終價格的計算 (假設折扣率欄位為 discount_value) **
+        IFNULL(sp.discount_rate, 1.0) AS discount_rate,
+        CASE WHEN sp.discount_rate IS NULL 
+             THEN p.price 
+             ELSE ROUND(p.price * sp.discount_rate, 2) 
+        END AS final_price
+
+    FROM favorites f
+    JOIN products p ON p.id = f.product_id
+    JOIN stores s ON s.id = p.store_id
+
+    -- 聯結評分
+    LEFT JOIN product_rating_stats rs ON rs.product_id = p.id
+
+    -- ** 核心修正：聯結特價資訊 **
+    LEFT JOIN specials sp ON sp.product_id = p.id
+                         AND sp.store_id = p.store_id
+                         AND sp.end_date >= date('now') -- 只篩選尚未過期的特價
+
+    WHERE f.user_id = ?
+    ORDER BY f.created_at DESC
+""", [1])
+
 @app.route("/api/favorites", methods=["GET"])
 @login_required
+@versioned("products", "stock", "stores", "specials", "product_rating_stats", per_user=("favorites",), daily=True)
 def api_favorites():
     uid = session["user_id"]
-    rows = query_db("""
-        SELECT 
-            f.id as fav_id, f.created_at,
-            p.id as product_id, p.name, p.image_url, p.price, p.category, p.remaining_qty as remaining_qty,
-            s.name as store_name, s.brand, s.address,
-            pr.avg_rating,
-            
-            -- ** 新增：折扣率和最終價格的計算 (假設折扣率欄位為 discount_value) **
-            IFNULL(sp.discount_rate, 1.0) AS discount_rate,
-            CASE WHEN sp.discount_rate IS NULL 
-                 THEN p.price 
-                 ELSE ROUND(p.price * sp.discount_rate, 2) 
-            END AS final_price
-            
-        FROM favorites f
-        JOIN products p ON p.id = f.product_id
-        JOIN stores s ON s.id = p.store_id
-        
-        -- 聯結評分
-        LEFT JOIN (
-            SELECT product_id, AVG(rating) AS avg_rating
-            FROM product_reviews
-            GROUP BY product_id
-        ) pr ON pr.product_id = p.id
-        
-        -- ** 核心修正：聯結特價資訊 **
-        LEFT JOIN specials sp ON sp.product_id = p.id
-                             AND sp.store_id = p.store_id
-                             AND sp.end_date >= date('now') -- 只篩選尚未過期的特價
-                             
-        WHERE f.user_id = ?
-        ORDER BY f.created_at DESC
-    """, [uid])
+    rows = query_db(FAVORITES_SQL, [uid])
     return jsonify([dict(r) for r in rows])
 
 @app.route("/api/favorites/add", methods=["POST"])
@@ -1188,7 +2806,8 @@ def api_favorites():
 def api_favorites_add():
     uid = session["user_id"]
     pid = int(request.form["product_id"])
-    exec_db("INSERT OR IGNORE INTO favorites (user_id, product_id) VALUES (?,?)", [uid, pid])
+    exec_db("INSERT OR IGNORE INTO favorites (user_id, product_id) VALUES (?,?)", [uid, pid], user_id=uid)
+    recommender_favorite_changed("add", uid, pid)
     return jsonify({"ok": True})
 
 @app.route("/api/favorites/add_notify", methods=["POST"])
@@ -1241,7 +2860,7 @@ def api_favorites_add_notify():
         msg = f"你加入喜好項目的「{pname}」正在特價，現在只要 {sale['final_price']}！"
         exec_db(
             "INSERT INTO notifications (user_id, message, product_id, product_name) VALUES (?,?,?,?)",
-            [uid, msg, pid, pname]
+            [uid, msg, pid, pname], user_id=uid
         )
 
         return jsonify({
@@ -1265,7 +2884,8 @@ def api_favorites_add_notify():
 def api_favorites_remove():
     uid = session["user_id"]
     pid = int(request.form["product_id"])
-    exec_db("DELETE FROM favorites WHERE user_id=? AND product_id=?", [uid, pid])
+    exec_db("DELETE FROM favorites WHERE user_id=? AND product_id=?", [uid, pid], user_id=uid)
+    recommender_favorite_changed("remove", uid, pid)
     return jsonify({"ok": True})
 
 '''
@@ -1293,35 +2913,88 @@ def onboarding():
 def recommend_page():
     return render_template("recommend.html")
 
+STORE_STOCK_SQL = hot_query("store_stock", """
+    SELECT store_id, total_qty
+    FROM store_stock_summary
+    WHERE store_id IN (SELECT value FROM json_each(?))
+""", ["[1, 2, 3]"])
+
+ALL_STORES_SQL = """
+    SELECT s.id, s.name, s.address, s.latitude, s.longitude, s.brand,
+           COALESCE(ss.total_qty, 0) as remaining_qty
+    FROM stores s
+    LEFT JOIN store_stock_summary ss ON ss.store_id = s.id
+"""
+
+def _store_batches(lat, lng, radius, brand, size=None):
+    """
+    逐批產生門市 dict（含 remaining_qty，有定位時另含 distance_km）。
+    size=None 一次全部；串流時每批只查該批門市的庫存。
+    """
+    # 有定位：走格子索引，只對半徑內的門市加總庫存
+    if lat is not None and lng is not None:
+        hits = grid_stores_within(lat, lng, radius)
+        if brand:
+            hits = [(s, d) for s, d in hits if (s["brand"] or "").lower() == brand.lower()]
+        size = size or max(len(hits), 1)
+        for i in range(0, len(hits), size):
+            chunk = hits[i:i + size]
+            stock_rows = query_db(STORE_STOCK_SQL, [json.dumps([s["id"] for s, _ in chunk])])
+            stock = {r["store_id"]: r["total_qty"] for r in stock_rows}
+            yield [dict(s, remaining_qty=stock.get(s["id"], 0), distance_km=round(d, 3)) for s, d in chunk]
+        return
+
+    for rows in iter_query_batches(ALL_STORES_SQL, size=size or STREAM_BATCH_ROWS):
+        yield [dict(r) for r in rows if not brand or (r["brand"] or "").lower() == brand.lower()]
+
 @app.route("/api/stores")
+@versioned("stores", "stock")
 def api_stores():
-    rows = query_db(
-        """
-        SELECT s.id, s.name, s.address, s.latitude, s.longitude, s.brand,
-               COALESCE(SUM(p.remaining_qty), 0) as remaining_qty
-        FROM stores s
-        LEFT JOIN products p ON p.store_id = s.id
-        GROUP BY s.id
-        """
-    )
     lat = request.args.get("lat", type=float)
     lng = request.args.get("lng", type=float)
     radius = request.args.get("radius", default=3.0, type=float)
     brand = request.args.get("brand")
-    out = []
-    for r in rows:
-        d = None
-        if lat is not None and lng is not None:
-            d = haversine(lat, lng, r["latitude"], r["longitude"])
-            if d > radius: continue
-        if brand and (r["brand"] or "").lower() != brand.lower():
-            continue
-        item = dict(r)
-        if d is not None:
-            item["distance_km"] = round(d, 3)
-        out.append(item)
-    return jsonify(out)
-
+    bad = bad_geo_args(lat, lng, radius)
+    if bad:
+        return bad
+
+    mode = stream_mode()
+    if mode:
+        return stream_batches(_store_batches(lat, lng, radius, brand, STREAM_BATCH_ROWS), mode)
+    return jsonify([s for batch in _store_batches(lat, lng, radius, brand) for s in batch])
+
+
+PRODUCT_REVIEWS_SQL = hot_query(
+    "product_reviews",
+    "SELECT r.*, a.username "
+    "FROM product_reviews r JOIN accounts a ON a.id = r.user_id "
+    "WHERE r.product_id = ? ORDER BY r.created_at DESC", [1]
+)
+
+def add_product_review(uid, pid, rating, comment):
+    """新增一筆評價，並在同一個 transaction 內更新 product_rating_stats。"""
+    with db_connection() as con:
+        try:
+            con.execute(
+                "INSERT INTO product_reviews (user_id, product_id, rating, comment) VALUES (?,?,?,?)",
+                (uid, pid, rating, comment)
+            )
+            # ON CONFLICT 的 SET 右側讀到的是更新前的值
+            con.execute("""
+                INSERT INTO product_rating_stats (product_id, rating_sum, rating_count, avg_rating)
+                VALUES (?, ?, 1, ?)
+                ON CONFLICT(product_id) DO UPDATE SET
+                  rating_sum   = rating_sum + excluded.rating_sum,
+                  rating_count = rating_count + 1,
+                  avg_rating   = CAST(rating_sum + excluded.rating_sum AS REAL) / (rating_count + 1)
+            """, (pid, rating, float(rating)))
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    bump_data_version("product_reviews")
+    bump_data_version("product_rating_stats")
+    invalidate_item_features()
 
 @app.route("/product/<int:pid>", methods=["GET", "POST"])
 @login_required
@@ -1341,22 +3014,15 @@ def product_page(pid):
         rating = int(request.form.get("rating", 0))
         comment = (request.form.get("comment") or "").strip()
         rating = max(1, min(5, rating))
-        exec_db(
-            "INSERT INTO product_reviews (user_id, product_id, rating, comment) VALUES (?,?,?,?)",
-            [uid, pid, rating, comment]
-        )
+        add_product_review(uid, pid, rating, comment)
         flash("感謝你的評價！", "ok")
         return redirect(url_for("product_page", pid=pid))
 
     # 顯示平均分/評論列表
-    reviews = query_db(
-        "SELECT r.*, a.username "
-        "FROM product_reviews r JOIN accounts a ON a.id = r.user_id "
-        "WHERE r.product_id = ? ORDER BY r.created_at DESC", [pid]
-    )
+    reviews = query_db(PRODUCT_REVIEWS_SQL, [pid])
     avg = query_db(
-        "SELECT AVG(rating) as avg, COUNT(*) as cnt "
-        "FROM product_reviews WHERE product_id = ?", [pid], one=True
+        "SELECT avg_rating as avg, rating_count as cnt "
+        "FROM product_rating_stats WHERE product_id = ?", [pid], one=True
     )
     return render_template("product.html", product=product, reviews=reviews, avg=avg)
 
@@ -1365,75 +3031,21 @@ def api_recommend():
     uid = session.get("user_id")            # 可為 None（訪客）
     brand = (request.args.get("brand") or "").lower()
     limit = int(request.args.get("limit", 12))
+    return jsonify(cached_result(("recommendations", uid, brand, None, limit), uid,
+                                 lambda: hybrid_recommend(uid, brand=brand, limit=limit)))
 
-    rows = query_db(
-        """
-        WITH prefs AS (
-            SELECT category, weight FROM user_preferences WHERE user_id = ?
-        ),
-        hist AS (
-            -- 用 favorites 當歷史偏好來源
-            SELECT p.category AS category, COUNT(*) AS q
-            FROM favorites f
-            JOIN products p ON p.id = f.product_id
-            WHERE (? IS NOT NULL) AND f.user_id = ?
-            GROUP BY p.category
-        ),
-        prefscore1 AS (
-            -- 合併使用者偏好 + 歷史收藏
-            SELECT category,
-                   COALESCE(weight,0) + COALESCE((SELECT q FROM hist WHERE hist.category = prefs.category),0) AS score
-            FROM prefs
-            UNION
-            SELECT category, q FROM hist WHERE category NOT IN (SELECT category FROM prefs)
-        ),
-        store_agg AS (
-            SELECT s.id AS store_id, s.name AS store_name, s.address, s.latitude, s.longitude, s.brand,
-                   COALESCE(SUM(p.remaining_qty),0) AS store_remaining
-            FROM stores s LEFT JOIN products p ON p.store_id = s.id
-            GROUP BY s.id
-        )
-        SELECT
-            p.id AS product_id, p.name, p.image_url, p.price, p.category, p.store_id,
-            sa.store_name, sa.address, sa.latitude, sa.longitude, sa.brand, sa.store_remaining,
-            COALESCE((SELECT AVG(rating) FROM product_reviews r WHERE r.product_id = p.id), 0) AS avg_rating,
-            COALESCE((SELECT COUNT(*) FROM product_reviews r WHERE r.product_id = p.id), 0) AS rating_count,
-            IFNULL(sp.discount_rate, 1.0) AS discount_rate,
-            CASE WHEN sp.discount_rate IS NULL THEN p.price ELSE ROUND(p.price * sp.discount_rate, 2) END AS final_price,
-            COALESCE((SELECT score FROM prefscore1 WHERE category = p.category), 0) AS pref_score
-        FROM products p
-        JOIN store_agg sa ON sa.store_id = p.store_id
-        LEFT JOIN specials sp ON sp.product_id = p.id AND sp.store_id = p.store_id AND sp.end_date >= date('now')
-        WHERE
-          (
-            ? = '' OR
-            (LOWER(REPLACE(REPLACE(IFNULL(sa.brand,''),' ',''),'-','')) LIKE '%7eleven%'   AND ? = '7-11') OR
-            (LOWER(REPLACE(REPLACE(IFNULL(sa.brand,''),' ',''),'-','')) LIKE '%familymart%' AND ? = 'familymart') OR
-            (LOWER(REPLACE(REPLACE(IFNULL(sa.brand,''),' ',''),'-','')) LIKE '%hilife%'     AND ? = 'hilife') OR
-            (LOWER(REPLACE(REPLACE(IFNULL(sa.brand,''),' ',''),'-','')) LIKE '%okmart%'     AND ? = 'okmart')
-          )
-        ORDER BY
-          pref_score DESC,
-          sa.store_remaining DESC,
-          discount_rate ASC,
-          final_price ASC
-        LIMIT ?
-        """,
-        [
-            uid,         # prefs.user_id
-            uid, uid,    # hist：保護訪客（uid=None時 hist 為空）
-            brand, brand, brand, brand, brand,
-            limit
-        ]
-    )
-    return jsonify([dict(r) for r in rows])
 
+NOTIFICATIONS_SQL = hot_query(
+    "notifications",
+    "SELECT * FROM notifications WHERE user_id = ? ORDER BY created_at DESC LIMIT 50", [1]
+)
 
 @app.route("/api/notifications")
 @login_required
+@versioned(per_user=("notifications",))
 def api_notifications():
     uid = session["user_id"]
-    rows = query_db("SELECT * FROM notifications WHERE user_id = ? ORDER BY created_at DESC LIMIT 50", [uid])
+    rows = query_db(NOTIFICATIONS_SQL, [uid])
     return jsonify([dict(r) for r in rows])
 @app.route("/notifications")
 @login_required
@@ -1445,22 +3057,20 @@ def notifications_page():
     return render_template("notifications.html", notifs=rows)
 
 
+HOTSPOT_SQL = hot_query("hotspot_store", """
+    SELECT s.name, ss.total_qty rem
+    FROM store_stock_summary ss JOIN stores s ON s.id = ss.store_id
+    ORDER BY ss.total_qty DESC
+    LIMIT 1
+""", [], allow_scan=("store_stock_summary",))   # 由 total_qty 索引尾端倒著讀，LIMIT 1 讀到第一筆就停
+
 @app.route("/api/trigger_hotspot_notif", methods=["POST"])
 @login_required
 def api_trigger_hotspot_notif():
     uid = session["user_id"]
-    store = query_db(
-        """
-        SELECT s.name, COALESCE(SUM(p.remaining_qty),0) rem
-        FROM stores s LEFT JOIN products p ON p.store_id = s.id
-        GROUP BY s.id
-        ORDER BY rem DESC
-        LIMIT 1
-        """,
-        one=True
-    )
+    store = query_db(HOTSPOT_SQL, one=True)
     if store and store["rem"] >= 50:
-        exec_db("INSERT INTO notifications (user_id, message) VALUES (?, ?)", [uid, f"附近「{store['name']}」剩餘大量商品，已通知合作機構協助消耗。"])
+        exec_db("INSERT INTO notifications (user_id, message) VALUES (?, ?)", [uid, f"附近「{store['name']}」剩餘大量商品，已通知合作機構協助消耗。"], user_id=uid)
         return jsonify({"ok": True, "message": "觸發成功"})
     return jsonify({"ok": False, "message": "目前沒有大量剩餘的店家"}), 400
 
@@ -1474,10 +3084,73 @@ def initdb():
         schema = f.read()
     con = sqlite3.connect(DB_PATH)
     con.executescript(schema)
+    # schema.sql 會重建資料表，migration 需要從頭再套用一次
+    con.execute("DROP TABLE IF EXISTS schema_version")
     con.commit()
     con.close()
+    ensure_schema()
+    build_store_grid()
     print("DB initialized.")
 
+_FROM_ALIAS_RE = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", re.I)
+_SQL_KEYWORDS = {"on", "where", "join", "left", "inner", "cross", "group", "order", "limit", "using", "natural"}
+
+def _query_aliases(sql, tables):
+    """從 FROM/JOIN 子句建立 別名 -> 實體資料表 對照（CTE 與 json_each 不算實體表）。"""
+    aliases = {}
+    for table, alias in _FROM_ALIAS_RE.findall(sql):
+        if table.lower() not in tables:
+            continue
+        aliases[table.lower()] = table.lower()
+        if alias and alias.lower() not in _SQL_KEYWORDS:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+@app.cli.command("indexcheck")
+def indexcheck():
+    """檢查熱門查詢的執行計畫，列出全表掃描與臨時自動索引；有問題時以非零狀態結束。"""
+    con = sqlite3.connect(DB_PATH)
+    tables = {r[0].lower() for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    indexes = {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    issues = 0
+
+    for name, _target in HOT_INDEXES:
+        if name not in indexes:
+            print(f"[MISSING] 索引 {name} 不存在（請重新啟動以套用 migration）")
+            issues += 1
+
+    for qname, (sql, args, allow_scan) in HOT_QUERIES.items():
+        aliases = _query_aliases(sql, tables)
+        allowed = {t.lower() for t in allow_scan}
+        try:
+            plan = [r[3] for r in con.execute("EXPLAIN QUERY PLAN " + sql, args)]
+        except sqlite3.Error as e:
+            print(f"[ERROR] {qname}: {e}")
+            issues += 1
+            continue
+        problems = []
+        for detail in plan:
+            m = re.match(r"(SCAN|SEARCH) (\w+)", detail)
+            table = aliases.get(m.group(2).lower()) if m else None
+            if not table or table in allowed:
+                continue   # CTE / 子查詢 / json_each 或明確允許掃描的表
+            # SCAN 不論有沒有 USING [COVERING] INDEX 都是整個表 / 索引掃過一遍，只有 SEARCH 才有索引條件
+            if "AUTOMATIC" in detail or m.group(1) == "SCAN":
+                problems.append(detail)
+        if problems:
+            issues += len(problems)
+            print(f"[SCAN] {qname}")
+            for detail in problems:
+                print(f"    {detail}")
+        else:
+            print(f"[OK] {qname}")
+    con.close()
+
+    if issues:
+        print(f"共 {issues} 個問題，請為上述查詢補上索引。")
+        raise SystemExit(1)
+    print("所有熱門查詢皆有使用索引。")
+
 @app.route("/api/spotlight_products")
 def api_spotlight_products():
     uid     = session.get("user_id")
@@ -1486,13 +3159,16 @@ def api_spotlight_products():
     radius  = float(request.args.get("radius", 3))
     brand_in = (request.args.get("brand") or "").strip().lower()
     limit   = int(request.args.get("limit", 12))
+    bad = bad_geo_args(lat, lng, radius)
+    if bad:
+        return bad
 
     # ---- 將前端品牌字串正規化成一個關鍵字（空字串 = 不過濾）----
     bnorm = brand_in.replace(" ", "").replace("-", "")
     norm_brand = ""
     if bnorm:
         if ("7" in bnorm and ("11" in bnorm or "eleven" in bnorm)) or "seven" in bnorm:
-            norm_brand = "7-11"         # 這裡只是一個「使用者輸入」代表，真正比對用 sa.norm_brand
+            norm_brand = "7-11"         # 這裡只是一個「使用者輸入」代表，真正比對用 BRAND_GROUPS
         elif "family" in bnorm or "全家" in brand_in:
             norm_brand = "familymart"
         elif "hilife" in bnorm or "hi-life" in brand_in or "萊爾富" in brand_in:
@@ -1500,130 +3176,25 @@ def api_spotlight_products():
         elif "okmart" in bnorm or bnorm == "ok" or "ok超商" in brand_in:
             norm_brand = "okmart"
         else:
-            norm_brand = bnorm  # 其他字串就當關鍵字
+            norm_brand = bnorm  # 其他字串不屬於任何品牌群組，不會有結果
 
-    sql = """
-    WITH prefs AS (
-        SELECT category, weight FROM user_preferences WHERE user_id = ?
-    ),
-    hist AS (
-        SELECT p.category, COUNT(*) AS q
-        FROM favorites f
-        JOIN products p ON p.id = f.product_id
-        WHERE (? IS NOT NULL) AND f.user_id = ?
-        GROUP BY p.category
-    ),
-    prefscore AS (
-        SELECT category,
-               COALESCE(weight,0) + COALESCE((SELECT q FROM hist WHERE hist.category=prefs.category),0) AS score
-        FROM prefs
-        UNION
-        SELECT category, q FROM hist WHERE category NOT IN (SELECT category FROM prefs)
-    ),
-    store_agg AS (
-        SELECT
-            s.id AS store_id, s.name AS store_name, s.address,
-            s.latitude, s.longitude,
-            s.brand,
-            LOWER(REPLACE(REPLACE(IFNULL(s.brand,''),' ',''),'-','')) AS norm_brand,
-            COALESCE(SUM(p.remaining_qty),0) AS store_remaining
-        FROM stores s
-        LEFT JOIN products p ON p.store_id = s.id
-        GROUP BY s.id
-    ),
-    prod AS (
-        SELECT
-            p.id AS product_id, p.name, p.image_url, p.price, p.category, p.store_id,
-            sa.store_name, sa.address, sa.latitude, sa.longitude, sa.brand, sa.norm_brand,
-            sa.store_remaining,
-            IFNULL(sp.discount_rate, 1.0) AS discount_rate,
-            CASE WHEN sp.discount_rate IS NULL THEN p.price ELSE ROUND(p.price * sp.discount_rate, 2) END AS final_price,
-            COALESCE((SELECT AVG(rating) FROM product_reviews r WHERE r.product_id = p.id), 0) AS avg_rating,
-            COALESCE((SELECT COUNT(*) FROM product_reviews r WHERE r.product_id = p.id), 0) AS rating_count,
-            COALESCE((SELECT score FROM prefscore WHERE category = p.category), 0) AS pref_score,
-
-            6371 * 2 * ASIN(
-              SQRT(
-                POWER(SIN(RADIANS((sa.latitude  - ?)/2.0)), 2) +
-                COS(RADIANS(?)) * COS(RADIANS(sa.latitude)) *
-                POWER(SIN(RADIANS((sa.longitude - ?)/2.0)), 2)
-              )
-            ) AS distance_km
-        FROM products p
-        JOIN store_agg sa ON sa.store_id = p.store_id
-        LEFT JOIN specials sp
-               ON sp.product_id = p.id
-              AND sp.store_id   = p.store_id
-              AND sp.end_date  >= date('now')
-        WHERE
-          (
-            ? = '' OR
-            (
-              /* 7-11：容許 7eleven / 711 / 7-11 等寫法 */
-              (sa.norm_brand LIKE '%7eleven%' OR sa.norm_brand LIKE '%711%')
-              AND ? IN ('7-11','7-eleven','7eleven','711')
-            ) OR
-            (
-              /* FamilyMart：容許 familymart / 全家 */
-              (sa.norm_brand LIKE '%familymart%')
-              AND ? IN ('familymart','全家')
-            ) OR
-            (
-              /* Hi-Life：容許 hilife / hi-life / 萊爾富 */
-              (sa.norm_brand LIKE '%hilife%')
-              AND ? IN ('hilife','hi-life','hi life','萊爾富')
-            ) OR
-            (
-              /* OKmart：容許 okmart / ok */
-              (sa.norm_brand LIKE '%okmart%')
-              AND ? IN ('okmart','ok')
-            )
-          )
-    )
-    SELECT *
-    FROM prod
-    WHERE distance_km <= ?
-    ORDER BY
-      pref_score DESC,
-      store_remaining DESC,
-      discount_rate ASC,
-      distance_km ASC,
-      final_price ASC
-    LIMIT ?;
-    """
-
-    # 參數順序「一定要」與 SQL 中的 ? 對齊
-    params = [
-        # prefs/hist
-        uid,         # prefs.user_id
-        uid, uid,    # hist: (? IS NOT NULL) 以及 f.user_id = ?
-
-        # 距離計算
-        lat, lat, lng,
-
-        # 品牌比對（第一個為空字串代表不過濾）
-        norm_brand,  # ? = ''
-        norm_brand,  # 7-11 群
-        norm_brand,  # familymart 群
-        norm_brand,  # hilife 群
-        norm_brand,  # okmart 群
-
-        # 半徑與筆數
-        radius,
-        limit
-    ]
-
-    rows = query_db(sql, params)
-    return jsonify([dict(r) for r in rows])
+    # 同一個位置格子共用結果（距離以第一次算的位置為準，誤差在 RESULT_CELL_DEG 以內）；
+    # 訪客先對齊到較大的格子中心，附近的訪客都拿到同一份
+    if uid is None:
+        lat, lng = guest_cell_center(lat, lng)
+    key = ("spotlight", uid, norm_brand, result_cell(lat, lng), (radius, limit))
+    return jsonify(cached_result(key, uid, lambda: hybrid_recommend(
+        uid, brand=norm_brand, limit=limit, near=grid_stores_within(lat, lng, radius))))
 
 try:
     from .ai_client import ask_model  # when used as package
 except ImportError:
     from ai_client import ask_model
-def _recommend_today_specials(limit:int=5):
+def _recommend_today_specials(limit:int=5, lat=None, lng=None):
     """
     取出未過期、仍有庫存、且有折扣(s.discount_rate < 1.0)的特價品。
     回傳每項 dict：{name, store_name, price, discount_rate, final_price, remaining_qty, end_date}
+    有傳入使用者位置時，另外附上 distance_km，並改成由近到遠排序。
     """
     import sqlite3, os, datetime
     db_path = os.path.join(os.path.dirname(__file__), "app.db")
@@ -1634,7 +3205,7 @@ def _recommend_today_specials(limit:int=5):
     cur.execute("""
         SELECT p.name, p.price, p.remaining_qty,
                s.discount_rate, s.end_date,
-               st.name AS store_name
+               st.id AS store_id, st.name AS store_name
         FROM specials s
         JOIN products p ON p.id = s.product_id
         JOIN stores st ON st.id = s.store_id
@@ -1643,10 +3214,16 @@ def _recommend_today_specials(limit:int=5):
           AND s.discount_rate < 1.0
         ORDER BY s.discount_rate ASC, p.price DESC
         LIMIT ?
-    """, (today, limit))
+    """, (today, -1 if lat is not None and lng is not None else limit))
     rows = [dict(r) for r in cur.fetchall()]
     conn.close()
 
+    # 有位置：用距離引擎一次算完所有特價門市的距離，取最近的 limit 筆
+    if lat is not None and lng is not None and rows:
+        dist = store_distances_km(lat, lng, [r["store_id"] for r in rows])
+        order = np.argsort(dist, kind="stable")[:limit]
+        rows = [dict(rows[i], distance_km=round(float(dist[i]), 2)) for i in order]
+
     # 算出折後價（final_price）
     for r in rows:
         try:
@@ -1655,20 +3232,21 @@ def _recommend_today_specials(limit:int=5):
             r["final_price"] = r["price"]
     return rows
 
-def _answer_for_food_question(q:str):
+def _answer_for_food_question(q:str, lat=None, lng=None):
     """
-    問「今天吃什麼？」或相近語句 -> 回 DB 推薦；否則回 None。
+    問「今天吃什麼？」或相近語句 -> 回 DB 推薦（有位置時優先推薦最近的門市）；否則回 None。
     """
     import re
     if not q:
         return None
     qn = q.strip().lower()
     patterns = [
-        r"今天.*吃什麼", r"晚餐.*吃什麼", r"中午.*吃什麼", r"吃什麼好", r"推薦.*(特價|打折|優惠)"
+        r"今天.*吃什麼", r"晚餐.*吃什麼", r"中午.*吃什麼", r"吃什麼好", r"推薦.*(特價|打折|優惠)",
+        r"(附近|最近).*(特價|打折|優惠|門市|店)"
     ]
     if any(re.search(p, q, flags=re.I) for p in patterns) or "what should i eat" in qn:
         try:
-            items = _recommend_today_specials(limit=6)
+            items = _recommend_today_specials(limit=6, lat=lat, lng=lng)
         except Exception as e:
             # 若資料表或欄位還沒建好，回友善訊息
             return f"讀取特價資料時發生錯誤：{e}"
@@ -1677,9 +3255,23 @@ def _answer_for_food_question(q:str):
         lines = ["今天的特價推薦："]
         for it in items:
             line = f"• {it['store_name']}｜{it['name']}：原價 {it['price']:.0f}，折扣 {it['discount_rate']:.2f} ➜ 約 {it['final_price']:.0f}（剩 {it['remaining_qty']}）"
+            if it.get("distance_km") is not None and not math.isnan(it["distance_km"]):
+                line += f"，距離約 {it['distance_km']:.1f} 公里"
             lines.append(line)
         return "\n".join(lines)
     return None
+def answer_food_question(question, lat=None, lng=None, referer="", title="Food Map AI Helper"):
+    """站內資料能回答的先回答，其餘交給 LLM。"""
+    ans = _answer_for_food_question(question, lat=lat, lng=lng)
+    if ans is None:
+        ans = ask_model(question, referer=referer, title=title)
+    return ans
+
+@job_handler("ai_ask", public=True)
+def _ai_ask_job(payload):
+    return {"answer": answer_food_question(payload.get("question") or "", payload.get("lat"), payload.get("lng"),
+                                           payload.get("referer") or "", payload.get("title") or "Food Map AI Helper")}
+
 @app.route("/api/ai_ask", methods=["POST"])
 def api_ai_ask():
     try:
@@ -1691,84 +3283,80 @@ def api_ai_ask():
         referer = request.headers.get("Origin") or request.headers.get("Referer") or ""
         title = "Food Map AI Helper"
 
-        ans = _answer_for_food_question(question)
-        if ans is None:
-            ans = ask_model(question, referer=referer, title=title)
-        return jsonify({"ok": True, "answer": ans})
+        # 選填：前端地圖中心，讓「附近有什麼特價」依距離回答
+        try:
+            lat = float(data["lat"]) if data.get("lat") is not None else None
+            lng = float(data["lng"]) if data.get("lng") is not None else None
+        except (TypeError, ValueError):
+            lat = lng = None
+
+        # async=true：交給背景工作（LLM 呼叫可能要好幾秒），立即回傳 job id
+        if data.get("async"):
+            payload = {"question": question, "lat": lat, "lng": lng, "referer": referer, "title": title}
+            return request_job("ai_ask", payload)
+        return jsonify({"ok": True, "answer": answer_food_question(question, lat, lng, referer, title)})
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
+ITEM_RECOMMEND_SQL = hot_query("item_recommend", """
+    SELECT 
+        p.id, p.name, p.image_url, p.price, p.category, 
+        s.name AS store_name, s.brand,
+        COALESCE(rs.avg_rating, 0) AS avg_rating,
+        IFNULL(sp.discount_rate, 1.0) AS discount_rate,
+        CASE WHEN sp.discount_rate IS NULL 
+             THEN p.price 
+             ELSE ROUND(p.price * sp.discount_rate, 2) 
+        END AS final_price
+    FROM products p
+    JOIN stores s ON s.id = p.store_id
+    LEFT JOIN product_rating_stats rs ON rs.product_id = p.id
+    LEFT JOIN specials sp ON sp.product_id = p.id
+                         AND sp.store_id = p.store_id
+                         AND sp.end_date >= date('now') -- 篩選尚未過期的特價
+    WHERE p.id IN (SELECT value FROM json_each(?))
+    LIMIT ?
+""", ['[1, 2, 3]', 12])
+
 @app.route("/api/favorites/item_recommend")
 @login_required
 def api_item_recommend():
     uid = session["user_id"]
     limit = int(request.args.get("limit", 12))
+    recommendations = cached_result(("item_recommend", uid, "", None, limit), uid,
+                                    lambda: _item_recommendations(uid, limit))
+    return jsonify({"ok": True, "recommendations": recommendations})
 
-    # 使用字典來儲存推薦商品ID及其來源（是從哪個收藏商品推薦來的）
-    recommended_products_with_reasons = defaultdict(list)
-
+def _item_recommendations(uid, limit):
+    """依使用者全部收藏商品的相似商品推薦，每筆附上推薦原因。"""
     # 1. 找出使用者已收藏的商品
     favorited_products = query_db("SELECT product_id, name FROM favorites f JOIN products p ON p.id = f.product_id WHERE f.user_id=?", [uid]) or []
     if not favorited_products:
-        return jsonify({"ok": True, "recommendations": []})
+        return []
+    names = {fav["product_id"]: fav["name"] for fav in favorited_products}
 
-    # 2. 對每個收藏商品，找出最相似的商品
-    for fav in favorited_products:
-        pid = fav["product_id"]
-        pname = fav["name"]
-        
-        # 呼叫修改後的函式，會回傳 ID 和分數
-        similar_items = get_similar_products(pid, n=5) or []
-        
-        for item in similar_items:
-            # 儲存推薦來源
-            recommended_products_with_reasons[item["product_id"]].append({
-                "source_product_id": pid,
-                "source_product_name": pname,
-                "score": item["score"]
-            })
-
-    # 3. 排除使用者已經收藏的商品
-    existing_pids = {fav["product_id"] for fav in favorited_products}
-    final_pids_to_recommend = list(recommended_products_with_reasons.keys() - existing_pids)
-
-    if not final_pids_to_recommend:
-        return jsonify({"ok": True, "recommendations": []})
-
-    # 4. 查詢商品資訊
-    placeholders = ",".join(["?"] * len(final_pids_to_recommend))
-    sql = f"""
-        SELECT 
-            p.id, p.name, p.image_url, p.price, p.category, 
-            s.name AS store_name, s.brand,
-            COALESCE((SELECT AVG(rating) FROM product_reviews r WHERE r.product_id = p.id), 0) AS avg_rating,
-            IFNULL(sp.discount_rate, 1.0) AS discount_rate,
-            CASE WHEN sp.discount_rate IS NULL 
-                 THEN p.price 
-                 ELSE ROUND(p.price * sp.discount_rate, 2) 
-            END AS final_price
-        FROM products p
-        JOIN stores s ON s.id = p.store_id
-        LEFT JOIN specials sp ON sp.product_id = p.id
-                             AND sp.store_id = p.store_id
-                             AND sp.end_date >= date('now') -- 篩選尚未過期的特價
-        WHERE p.id IN ({placeholders})
-        LIMIT ?
-    """
-    params = final_pids_to_recommend + [limit]
-    db_results = query_db(sql, params) or []
+    # 2. 所有收藏商品一起算：每個收藏取前 5 個相似商品，排除已收藏，依分數取前 limit 個
+    ranked = recommend_for_items(list(names), n_per_seed=5, limit=limit)
+    if not ranked:
+        return []
 
-    # 5. 將推薦原因合併到最終結果
+    # 3. 查詢商品資訊
+    params = [json.dumps([pid for pid, _, _ in ranked]), limit]
+    rows_by_id = {row["id"]: dict(row) for row in query_db(ITEM_RECOMMEND_SQL, params) or []}
+
+    # 4. 將推薦原因合併到最終結果（依相似度分數排序）
     final_recommendations = []
-    for row in db_results:
-        rec_item = dict(row)
-        rec_item["reasons"] = recommended_products_with_reasons[row["id"]]
+    for pid, _, reasons in ranked:
+        rec_item = rows_by_id.get(pid)
+        if rec_item is None:
+            continue
+        rec_item["reasons"] = [
+            {"source_product_id": src, "source_product_name": names[src], "score": score}
+            for src, score in reasons
+        ]
         final_recommendations.append(rec_item)
-    
-    # 你可以選擇對結果進行排序，例如根據相似度分數
-    final_recommendations.sort(key=lambda x: max(r['score'] for r in x['reasons']), reverse=True)
 
-    return jsonify({"ok": True, "recommendations": final_recommendations})
+    return final_recommendations
 
 # 猜你想搜
 @app.route("/api/popular_products")
@@ -1793,52 +3381,68 @@ def api_popular_categories():
     # 只回傳類別名稱的列表
     return jsonify([row['name'] for row in rows])
 
-__ensure_notifications_schema()
+ensure_schema()
+build_store_grid()
+threading.Thread(target=build_sellout_table, daemon=True).start()
+start_recommender()
 
 #庫存預測
-@app.route("/api/forecast/<int:pid>")
-def api_forecast(pid):
-    try:
-        # 呼叫預測函式
-        sell_out_time = _forecast_stock(pid)
-        
-        message = "" 
-
-        # 根據回傳值，提供不同的訊息
-        if sell_out_time == 0:
-            now = datetime.now()
-            next_restock_dt = None
-
-            # 找出今天或明天最接近的補貨時間點 (假設 RESTOCK_TIMES 已定義)
-            for rh, rm in RESTOCK_TIMES:
-                restock_dt = now.replace(hour=rh, minute=rm, second=0, microsecond=0)
-                if restock_dt > now:
-                    next_restock_dt = restock_dt
-                    break
+FORECAST_BATCH_MAX = 200
 
-            # 如果今天沒有了，就從明天的第一個時間點開始
-            if next_restock_dt is None:
-                rh, rm = RESTOCK_TIMES[0]
-                next_restock_dt = now.replace(hour=rh, minute=rm, second=0, microsecond=0) + timedelta(days=1)
+def _forecast_message(sell_out_time):
+    """把 _forecast_stock 的回傳值轉成 (sell_out_time_hours, 訊息)；庫存為 0 時改回傳距離下次進貨的負小時數。"""
+    message = "" 
 
-            # 計算距離下次進貨的時間 (分鐘)
-            time_to_restock_minutes = (next_restock_dt - now).total_seconds() / 60
-            
-            # 庫存為 0 的時候，回傳下次進貨時間（用負數表示）
-            sell_out_time = -round(time_to_restock_minutes / 60, 1)
-            message = "庫存為 0，預計稍後補貨"
+    # 根據回傳值，提供不同的訊息
+    if sell_out_time == 0:
+        now = datetime.now()
+        next_restock_dt = None
+
+        # 找出今天或明天最接近的補貨時間點 (假設 RESTOCK_TIMES 已定義)
+        for rh, rm in RESTOCK_TIMES:
+            restock_dt = now.replace(hour=rh, minute=rm, second=0, microsecond=0)
+            if restock_dt > now:
+                next_restock_dt = restock_dt
+                break
+
+        # 如果今天沒有了，就從明天的第一個時間點開始
+        if next_restock_dt is None:
+            rh, rm = RESTOCK_TIMES[0]
+            next_restock_dt = now.replace(hour=rh, minute=rm, second=0, microsecond=0) + timedelta(days=1)
+
+        # 計算距離下次進貨的時間 (分鐘)
+        time_to_restock_minutes = (next_restock_dt - now).total_seconds() / 60
+        
+        # 庫存為 0 的時候，回傳下次進貨時間（用負數表示）
+        sell_out_time = -round(time_to_restock_minutes / 60, 1)
+        message = "庫存為 0，預計稍後補貨"
 
-        elif sell_out_time == -1:
-            message = "商品不存在或無法預測"
+    elif sell_out_time == -1:
+        message = "商品不存在或無法預測"
+    else:
+        # 預計售罄時間 > 0 的情況
+        if sell_out_time >= 24:
+            message = "庫存充足 (24小時以上)"
         else:
-            # 預計售罄時間 > 0 的情況
-            if sell_out_time >= 24:
-                message = "庫存充足 (24小時以上)"
-            else:
-                message = f"預計 {sell_out_time} 小時內售罄"
+            message = f"預計 {sell_out_time} 小時內售罄"
+    return sell_out_time, message
+
+def _forecast_entry(hours, p10, p90):
+    """單一商品的預測 JSON；p10/p90 只在有售罄預測時提供（庫存為 0 或商品不存在時為 null）。"""
+    sell_out_time, message = _forecast_message(hours)
+    if hours <= 0:
+        p10 = p90 = None
+    return {"ok": True, "message": message, "sell_out_time_hours": sell_out_time,
+            "p10_hours": p10, "p90_hours": p90}
 
-        # 確保在成功路徑上回傳 JSON
-        return jsonify({"ok": True, "message": message, "sell_out_time_hours": sell_out_time})
+@app.route("/api/forecast/<int:pid>")
+def api_forecast(pid):
+    try:
+        # 呼叫預測函式；?mode=mc|analytic|auto
+        mode = request.args.get("mode", "auto")
+        if mode not in ("auto", "mc", "analytic"):
+            return jsonify({"ok": False, "message": "mode 必須是 auto、mc 或 analytic"}), 400
+        return jsonify(_forecast_entry(*_forecast_batch([pid], mode)[pid]))
     
     except Exception as e:
         # 捕捉所有運行時錯誤，並回傳明確的錯誤訊息
@@ -1847,14 +3451,55 @@ def api_forecast(pid):
         # 【修正目標】：回傳 500 錯誤狀態，前端會收到這個明確的 JSON
         return jsonify({"ok": False, "message": f"預測伺服器內部崩潰: {e}", "sell_out_time_hours": -999.0}), 500
 
-if __name__ == "__main__":
-    # 啟動背景線程
-    t = threading.Thread(target=update_stock, daemon=True)
-    t.start()
+@job_handler("forecast", public=True)
+def _forecast_job(payload):
+    pids = [int(x) for x in payload.get("ids") or []][:FORECAST_BATCH_MAX]
+    mode = payload.get("mode") or "auto"
+    return {str(pid): _forecast_entry(*bands) for pid, bands in _forecast_batch(pids, mode).items()}
 
-    # 確保資料庫結構存在
-    __ensure_notifications_schema()
+@app.route("/api/forecast")
+def api_forecast_batch():
+    """一次預測多個商品：/api/forecast?ids=1,2,3，每個商品的結果格式與 /api/forecast/<pid> 相同。"""
+    try:
+        pids = list(dict.fromkeys(int(x) for x in (request.args.get("ids") or "").split(",") if x.strip()))
+    except ValueError:
+        return jsonify({"ok": False, "message": "ids 必須是以逗號分隔的商品編號"}), 400
+    if len(pids) > FORECAST_BATCH_MAX:
+        return jsonify({"ok": False, "message": f"一次最多預測 {FORECAST_BATCH_MAX} 個商品"}), 400
+    mode = request.args.get("mode", "auto")
+    if mode not in ("auto", "mc", "analytic"):
+        return jsonify({"ok": False, "message": "mode 必須是 auto、mc 或 analytic"}), 400
+
+    # async=1：交給背景工作，結果格式同 forecasts
+    if request.args.get("async") == "1":
+        return request_job("forecast", {"ids": pids, "mode": mode})
 
-    # 🌟 啟動背景任務
+    try:
+        forecasts = {str(pid): _forecast_entry(*bands) for pid, bands in _forecast_batch(pids, mode).items()}
+        return jsonify({"ok": True, "forecasts": forecasts})
+    except Exception as e:
+        print(f"FATAL Error in api_forecast_batch for PIDs {pids}: {e}")
+        return jsonify({"ok": False, "message": f"預測伺服器內部崩潰: {e}", "forecasts": {}}), 500
+
+#庫存歷史查詢
+@app.route("/api/stock_history/<int:pid>")
+def api_stock_history(pid):
+    """/api/stock_history/<pid>?hours=24&resolution=auto|minute|hour|day"""
+    try:
+        hours = float(request.args.get("hours", 24))
+    except ValueError:
+        return jsonify({"ok": False, "message": "hours 必須是數字"}), 400
+    if not math.isfinite(hours) or hours <= 0:
+        return jsonify({"ok": False, "message": "hours 必須是大於 0 的數字"}), 400
+    hours = min(hours, HISTORY_DAILY_RETENTION_DAYS * 24)   # 超過保留期間也沒有資料
+    resolution = request.args.get("resolution", "auto")
+    if resolution not in ("auto", "minute", "hour", "day"):
+        return jsonify({"ok": False, "message": "resolution 必須是 auto、minute、hour 或 day"}), 400
+    end = datetime.now()
+    resolution, points = stock_history(pid, end - timedelta(hours=hours), end, resolution)
+    return jsonify({"ok": True, "product_id": pid, "resolution": resolution, "points": points})
+
+if __name__ == "__main__":
+    # 🌟 啟動背景任務（庫存更新執行緒只能有一條，見 update_stock）
     start_background_tasks()
     app.run(host="0.0.0.0", port=5000, debug=True)